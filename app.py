@@ -1,14 +1,55 @@
 #!/usr/bin/python3
 # Copyright (c) BDist Development Team
 # Distributed under the terms of the Modified BSD License.
+import csv
+import fcntl
+import functools
+import hashlib
+import io
+import json
+import multiprocessing
 import os
+import secrets
+import threading
+import time
+import weakref
+from collections import Counter, OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
 from logging.config import dictConfig
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 
+import click
 import psycopg
-from flask import Flask, flash, jsonify, redirect, render_template, request, url_for
-from psycopg.rows import namedtuple_row
-from psycopg.errors import UniqueViolation
+from flask import (
+    Flask,
+    Response,
+    before_render_template,
+    flash,
+    g,
+    has_app_context,
+    has_request_context,
+    jsonify,
+    make_response,
+    redirect,
+    render_template,
+    request,
+    send_file,
+    session,
+    stream_template,
+    stream_with_context,
+    template_rendered,
+    url_for,
+)
+from psycopg import sql
+from psycopg.rows import namedtuple_row, tuple_row
+from psycopg.errors import DataError, ExclusionViolation, ForeignKeyViolation, UniqueViolation
+from psycopg.types.json import Jsonb
+from psycopg_pool import ConnectionPool, PoolTimeout
+from werkzeug.routing import BaseConverter, ValidationError
+
+IMPORT_STARTED = time.perf_counter()
 
 # postgres://{user}:{password}@{hostname}:{port}/{database-name}
 DATABASE_URL = "postgres://db:db@postgres/db"
@@ -36,6 +77,998 @@ app = Flask(__name__)
 app.config.from_prefixed_env()
 log = app.logger
 
+# Seconds spent importing this module and in warm_up(), shown on /metrics
+startup_times = {}
+
+# Idempotent DDL backing the indexed query paths; applied with `flask migrate`.
+SCHEMA_MIGRATIONS = [
+    # Client search: trigram indexes serve LIKE '%x%' on the text fields and
+    # the (name, VAT) index serves the ordered keyset pagination.
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm;",
+    "CREATE INDEX IF NOT EXISTS client_name_trgm_idx ON client USING gin (name gin_trgm_ops);",
+    "CREATE INDEX IF NOT EXISTS client_city_trgm_idx ON client USING gin (city gin_trgm_ops);",
+    "CREATE INDEX IF NOT EXISTS client_street_trgm_idx ON client USING gin (street gin_trgm_ops);",
+    "CREATE INDEX IF NOT EXISTS client_zip_trgm_idx ON client USING gin (zip gin_trgm_ops);",
+    "CREATE INDEX IF NOT EXISTS client_name_vat_idx ON client (name, VAT);",
+    # Dashboard streaming and the /api/consultations keyset.
+    "CREATE INDEX IF NOT EXISTS facts_consultations_date_vat_idx ON facts_consultations (date, VAT);",
+    # Client appointment history, paginated by date per client.
+    "CREATE INDEX IF NOT EXISTS appointment_client_date_idx ON appointment (VAT_client, date_timestamp DESC);",
+    # Doctor scheduling: each appointment occupies a one-hour range and the
+    # exclusion constraint rejects overlapping bookings of the same doctor.
+    "CREATE EXTENSION IF NOT EXISTS btree_gist;",
+    """
+    ALTER TABLE appointment ADD COLUMN IF NOT EXISTS slot tsrange
+        GENERATED ALWAYS AS (tsrange(date_timestamp, date_timestamp + interval '1 hour')) STORED;
+    """,
+    """
+    DO $$
+    BEGIN
+        IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'appointment_no_overlap') THEN
+            ALTER TABLE appointment ADD CONSTRAINT appointment_no_overlap
+                EXCLUDE USING gist (VAT_doctor WITH =, slot WITH &&);
+        END IF;
+    END
+    $$;
+    """,
+    # Diagnostic codes: sequence-backed IDs and one row per description, so
+    # codes can be resolved or created with INSERT ... ON CONFLICT.
+    "CREATE SEQUENCE IF NOT EXISTS diagnostic_code_id_seq OWNED BY diagnostic_code.ID;",
+    "SELECT setval('diagnostic_code_id_seq', COALESCE((SELECT MAX(ID) FROM diagnostic_code), 0) + 1, false);",
+    "ALTER TABLE diagnostic_code ALTER COLUMN ID SET DEFAULT nextval('diagnostic_code_id_seq');",
+    "CREATE UNIQUE INDEX IF NOT EXISTS diagnostic_code_description_key ON diagnostic_code (description);",
+    # Date-range reporting: facts are appended in date order, so a BRIN index
+    # lets range scans skip every block outside the requested interval.
+    "CREATE INDEX IF NOT EXISTS facts_consultations_date_brin_idx ON facts_consultations USING brin (date);",
+    # Dashboard aggregates; the unique indexes allow REFRESH ... CONCURRENTLY.
+    """
+    CREATE MATERIALIZED VIEW IF NOT EXISTS mv_consults_by_client AS
+    SELECT VAT, COUNT(*) AS total_consultations
+    FROM facts_consultations
+    GROUP BY VAT;
+    """,
+    "CREATE UNIQUE INDEX IF NOT EXISTS mv_consults_by_client_vat_idx ON mv_consults_by_client (VAT);",
+    """
+    CREATE MATERIALIZED VIEW IF NOT EXISTS mv_consults_by_year AS
+    SELECT EXTRACT(YEAR FROM date)::int AS year, COUNT(*) AS total_consultations
+    FROM facts_consultations
+    GROUP BY EXTRACT(YEAR FROM date);
+    """,
+    "CREATE UNIQUE INDEX IF NOT EXISTS mv_consults_by_year_year_idx ON mv_consults_by_year (year);",
+    # Note search: full-text vectors kept by Postgres on every insert/update
+    # (new_consultation_soap, new_appointment, the JSON and bulk APIs alike).
+    """
+    ALTER TABLE consultation ADD COLUMN IF NOT EXISTS soap_tsv tsvector
+        GENERATED ALWAYS AS (
+            setweight(to_tsvector('english', coalesce(SOAP_A, '')), 'A') ||
+            setweight(to_tsvector('english', coalesce(SOAP_S, '') || ' ' || coalesce(SOAP_O, '')), 'B') ||
+            setweight(to_tsvector('english', coalesce(SOAP_P, '')), 'C')
+        ) STORED;
+    """,
+    "CREATE INDEX IF NOT EXISTS consultation_soap_tsv_idx ON consultation USING gin (soap_tsv);",
+    """
+    ALTER TABLE appointment ADD COLUMN IF NOT EXISTS description_tsv tsvector
+        GENERATED ALWAYS AS (to_tsvector('english', coalesce(description, ''))) STORED;
+    """,
+    "CREATE INDEX IF NOT EXISTS appointment_description_tsv_idx ON appointment USING gin (description_tsv);",
+    # Background job queue, claimed by `flask jobs-worker` with SKIP LOCKED.
+    """
+    CREATE TABLE IF NOT EXISTS jobs (
+        id bigserial PRIMARY KEY,
+        type text NOT NULL,
+        params jsonb NOT NULL DEFAULT '{}',
+        status text NOT NULL DEFAULT 'queued' CHECK (status IN ('queued', 'running', 'done', 'failed')),
+        attempts int NOT NULL DEFAULT 0,
+        progress real NOT NULL DEFAULT 0,
+        result jsonb,
+        error text,
+        run_after timestamptz NOT NULL DEFAULT now(),
+        created_at timestamptz NOT NULL DEFAULT now(),
+        started_at timestamptz,
+        heartbeat_at timestamptz,
+        finished_at timestamptz
+    );
+    """,
+    "CREATE INDEX IF NOT EXISTS jobs_queued_idx ON jobs (run_after, id) WHERE status = 'queued';",
+    # Incremental facts ETL: triggers log every touched consultation with the
+    # writing transaction's id, and `flask etl-facts` upserts the facts of
+    # logged consultations past its watermark (see load_facts_batch).
+    "ALTER TABLE facts_consultations ADD COLUMN IF NOT EXISTS VAT_doctor text;",
+    "ALTER TABLE facts_consultations ADD COLUMN IF NOT EXISTS date_timestamp timestamp;",
+    """
+    CREATE UNIQUE INDEX IF NOT EXISTS facts_consultations_consultation_key
+        ON facts_consultations (VAT_doctor, date_timestamp);
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS consultation_changes (
+        id bigserial PRIMARY KEY,
+        xid xid8 NOT NULL DEFAULT pg_current_xact_id(),
+        VAT_doctor text NOT NULL,
+        date_timestamp timestamp NOT NULL,
+        changed_at timestamptz NOT NULL DEFAULT clock_timestamp()
+    );
+    """,
+    "CREATE INDEX IF NOT EXISTS consultation_changes_xid_id_idx ON consultation_changes (xid, id);",
+    """
+    CREATE TABLE IF NOT EXISTS etl_watermark (
+        name text PRIMARY KEY,
+        last_xid xid8 NOT NULL DEFAULT '0',
+        last_id bigint NOT NULL DEFAULT 0,
+        updated_at timestamptz NOT NULL DEFAULT now()
+    );
+    """,
+    "INSERT INTO etl_watermark (name) VALUES ('facts_consultations') ON CONFLICT DO NOTHING;",
+    """
+    CREATE OR REPLACE FUNCTION log_consultation_change() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP <> 'INSERT' THEN
+            INSERT INTO consultation_changes (VAT_doctor, date_timestamp) VALUES (OLD.VAT_doctor, OLD.date_timestamp);
+        END IF;
+        IF TG_OP <> 'DELETE' THEN
+            INSERT INTO consultation_changes (VAT_doctor, date_timestamp) VALUES (NEW.VAT_doctor, NEW.date_timestamp);
+        END IF;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql;
+    """,
+    """
+    CREATE OR REPLACE FUNCTION log_client_zip_change() RETURNS trigger AS $$
+    BEGIN
+        INSERT INTO consultation_changes (VAT_doctor, date_timestamp)
+        SELECT c.VAT_doctor, c.date_timestamp
+        FROM appointment a
+        JOIN consultation c ON c.VAT_doctor = a.VAT_doctor AND c.date_timestamp = a.date_timestamp
+        WHERE a.VAT_client = NEW.VAT;
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql;
+    """,
+    "DROP TRIGGER IF EXISTS consultation_facts_change ON consultation;",
+    """
+    CREATE TRIGGER consultation_facts_change AFTER INSERT OR UPDATE OR DELETE ON consultation
+        FOR EACH ROW EXECUTE FUNCTION log_consultation_change();
+    """,
+    "DROP TRIGGER IF EXISTS consultation_diagnostic_facts_change ON consultation_diagnostic;",
+    """
+    CREATE TRIGGER consultation_diagnostic_facts_change AFTER INSERT OR UPDATE OR DELETE ON consultation_diagnostic
+        FOR EACH ROW EXECUTE FUNCTION log_consultation_change();
+    """,
+    "DROP TRIGGER IF EXISTS procedure_in_consultation_facts_change ON procedure_in_consultation;",
+    """
+    CREATE TRIGGER procedure_in_consultation_facts_change AFTER INSERT OR UPDATE OR DELETE ON procedure_in_consultation
+        FOR EACH ROW EXECUTE FUNCTION log_consultation_change();
+    """,
+    "DROP TRIGGER IF EXISTS client_facts_change ON client;",
+    """
+    CREATE TRIGGER client_facts_change AFTER UPDATE OF zip ON client
+        FOR EACH ROW WHEN (OLD.zip IS DISTINCT FROM NEW.zip) EXECUTE FUNCTION log_client_zip_change();
+    """,
+]
+
+class Metrics:
+    """In-process counters and latency histograms, rendered for Prometheus."""
+
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self._histograms = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * len(self.BUCKETS), 0.0, 0]
+            for i, bound in enumerate(self.BUCKETS):
+                if value <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    @staticmethod
+    def _labels(labels, **extra):
+        labels = list(labels) + list(extra.items())
+        if not labels:
+            return ""
+        escape = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        return "{" + ",".join(f'{key}="{escape(value)}"' for key, value in labels) + "}"
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for (name, labels), value in sorted(self._counters.items()):
+                lines.append(f"{name}{self._labels(labels)} {value}")
+            for (name, labels), (buckets, total, count) in sorted(self._histograms.items()):
+                for bound, bucket in zip(self.BUCKETS, buckets):
+                    lines.append(f"{name}_bucket{self._labels(labels, le=bound)} {bucket}")
+                lines.append(f"{name}_bucket{self._labels(labels, le='+Inf')} {count}")
+                lines.append(f"{name}_sum{self._labels(labels)} {total}")
+                lines.append(f"{name}_count{self._labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+def current_route():
+    return (request.endpoint or "unknown") if has_request_context() else "background"
+
+
+def statement_label(cur, query):
+    """Whitespace-collapsed SQL text used as the per-statement metric label."""
+    if not isinstance(query, (str, bytes)):
+        query = query.as_string(cur.connection)
+    if isinstance(query, bytes):
+        query = query.decode()
+    return " ".join(query.split())[:200]
+
+
+class InstrumentedCursorMixin:
+    """Times every execute(), counts rows and logs slow statements.
+
+    Statements slower than FLASK_SLOW_QUERY_MS are logged; with
+    FLASK_EXPLAIN_SLOW_QUERIES set, read-only ones are re-run under
+    EXPLAIN ANALYZE and the plan is logged too.
+    """
+
+    def execute(self, query, params=None, **kwargs):
+        started = time.perf_counter()
+        result = super().execute(query, params, **kwargs)
+        self._record(query, params, time.perf_counter() - started)
+        return result
+
+    def executemany(self, query, params_seq, **kwargs):
+        started = time.perf_counter()
+        result = super().executemany(query, params_seq, **kwargs)
+        self._record(query, None, time.perf_counter() - started)
+        return result
+
+    def _record(self, query, params, elapsed):
+        route = current_route()
+        label = statement_label(self, query)
+        metrics.observe("db_query_duration_seconds", elapsed, route=route, statement=label)
+        metrics.inc("db_queries_total", route=route)
+        if self.rowcount >= 0:
+            metrics.inc("db_rows_total", self.rowcount, route=route)
+
+        if elapsed * 1000 < app.config.get("SLOW_QUERY_MS", 200):
+            return
+        log.warning(f"Slow query ({elapsed * 1000:.1f} ms) in {route}: {label}")
+        # Only plain SELECTs: a WITH may hold INSERT/UPDATE/DELETE, which
+        # EXPLAIN ANALYZE would run a second time
+        if params is not None and app.config.get("EXPLAIN_SLOW_QUERIES") and label.upper().startswith("SELECT"):
+            try:
+                # Savepoint, always rolled back, so the EXPLAIN can neither
+                # abort the caller's transaction nor leave anything behind
+                with self.connection.transaction(), psycopg.Cursor(self.connection) as explain:
+                    plan = explain.execute(
+                        sql.SQL("EXPLAIN (ANALYZE, BUFFERS) ") + (sql.SQL(query) if isinstance(query, str) else query),
+                        params,
+                    ).fetchall()
+                    raise psycopg.Rollback()
+                log.warning("Plan:\n" + "\n".join(row[0] for row in plan))
+            except psycopg.Error as e:
+                log.warning(f"Could not EXPLAIN slow query: {e}")
+
+
+class InstrumentedCursor(InstrumentedCursorMixin, psycopg.Cursor):
+    pass
+
+
+class InstrumentedServerCursor(InstrumentedCursorMixin, psycopg.ServerCursor):
+    pass
+
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+
+@app.teardown_request
+def record_request_time(exception):
+    started = g.pop("request_started", None)
+    if started is not None:
+        metrics.observe(
+            "http_request_duration_seconds", time.perf_counter() - started,
+            route=current_route(), method=request.method,
+        )
+
+
+@before_render_template.connect_via(app)
+def start_render_timer(sender, template, context, **extra):
+    g.render_started = time.perf_counter()
+
+
+@template_rendered.connect_via(app)
+def record_render_time(sender, template, context, **extra):
+    started = g.pop("render_started", None)
+    if started is not None:
+        metrics.observe("template_render_seconds", time.perf_counter() - started, template=template.name)
+
+
+def make_pool(conninfo, name):
+    """Connection pool with the sizes, timeout and cursors shared by every route.
+
+    Sizes and timeout can be tuned with FLASK_POOL_MIN_SIZE, FLASK_POOL_MAX_SIZE
+    and FLASK_POOL_TIMEOUT; every replica gets a pool of the same shape.
+    """
+    return ConnectionPool(
+        conninfo=conninfo,
+        min_size=app.config.get("POOL_MIN_SIZE", 4),
+        max_size=app.config.get("POOL_MAX_SIZE", 16),
+        timeout=app.config.get("POOL_TIMEOUT", 10),
+        max_idle=app.config.get("POOL_MAX_IDLE", 600),
+        check=ConnectionPool.check_connection,
+        kwargs={
+            "autocommit": True,
+            "cursor_factory": InstrumentedCursor,
+            "server_cursor_factory": InstrumentedServerCursor,
+        },
+        name=name,
+        open=False,
+    )
+
+
+def replica_urls():
+    """FLASK_DATABASE_REPLICA_URLS, as a JSON list or a comma-separated string."""
+    urls = app.config.get("DATABASE_REPLICA_URLS", [])
+    if isinstance(urls, str):
+        urls = [url.strip() for url in urls.split(",") if url.strip()]
+    return urls
+
+
+# The primary takes every write; replicas only serve views marked @read_only.
+pool = make_pool(app.config.get("DATABASE_URL", DATABASE_URL), "clinic")
+replica_pools = [make_pool(url, f"clinic-replica-{i}") for i, url in enumerate(replica_urls())]
+
+
+class ReplicaRouter:
+    """Pick the pool a request borrows its connection from.
+
+    Read-only views go to the replicas, round robin, skipping any that lag
+    more than FLASK_REPLICA_MAX_LAG seconds. Everything else, and any read
+    within FLASK_REPLICA_STICKY_SECONDS of the same session's last write,
+    goes to the primary so users always see their own changes. Replica lag
+    is sampled at most every FLASK_REPLICA_LAG_CHECK_INTERVAL seconds.
+    """
+
+    # 0 on a caught-up standby, and on a plain server (e.g. a second local instance)
+    LAG_QUERY = """
+        SELECT CASE
+            WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+            ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+        END AS lag
+    """
+
+    def __init__(self, primary, replicas):
+        self.primary = primary
+        self.replicas = replicas
+        self._turn = 0
+        self._lag = {}
+        self._lock = threading.Lock()
+
+    def lag(self, replica):
+        """Replication lag of `replica` in seconds, infinite if unreachable."""
+        now = time.monotonic()
+        with self._lock:
+            checked_at, seconds = self._lag.get(replica.name, (None, None))
+        if checked_at is not None and now - checked_at < app.config.get("REPLICA_LAG_CHECK_INTERVAL", 1):
+            return seconds
+        ensure_pools_open()
+        try:
+            with replica.connection() as conn:
+                seconds = float(conn.execute(self.LAG_QUERY).fetchone()[0])
+        except (psycopg.Error, PoolTimeout) as e:
+            log.warning(f"Replica {replica.name} unavailable: {e}")
+            seconds = float("inf")
+        with self._lock:
+            self._lag[replica.name] = (now, seconds)
+        return seconds
+
+    def sticky(self):
+        wrote_at = session.get("wrote_at")
+        return wrote_at is not None and time.time() - wrote_at < app.config.get("REPLICA_STICKY_SECONDS", 5)
+
+    def choose(self, read_only):
+        if read_only and self.replicas and not self.sticky():
+            with self._lock:
+                start, self._turn = self._turn, self._turn + 1
+            for i in range(len(self.replicas)):
+                replica = self.replicas[(start + i) % len(self.replicas)]
+                if self.lag(replica) <= app.config.get("REPLICA_MAX_LAG", 5):
+                    return replica
+        return self.primary
+
+    def pools(self):
+        return [self.primary, *self.replicas]
+
+
+router = ReplicaRouter(pool, replica_pools)
+pools_opened = threading.Event()
+
+
+def open_pools(wait=False, timeout=30):
+    """Open the primary and replica pools, which are created closed.
+
+    With `wait`, block until each holds FLASK_POOL_MIN_SIZE connections.
+    """
+    for db_pool in router.pools():
+        db_pool.open(wait=wait, timeout=timeout)
+    pools_opened.set()
+
+
+def ensure_pools_open():
+    if not pools_opened.is_set():
+        open_pools()
+
+
+def read_only(view):
+    """Mark a view as safe to serve from a read replica."""
+    view.read_only = True
+    return view
+
+
+def read_only_request():
+    view = app.view_functions.get(request.endpoint) if has_request_context() else None
+    return getattr(view, "read_only", False)
+
+
+def get_db():
+    """Borrow a pooled connection, at most one per request."""
+    if "db" not in g:
+        ensure_pools_open()
+        started = time.perf_counter()
+        g.db_pool = router.choose(read_only_request())
+        g.db = g.db_pool.getconn()
+        served_by(g.db_pool)
+        metrics.observe("db_connection_acquire_seconds", time.perf_counter() - started, route=current_route())
+        metrics.inc("db_connections_routed_total", route=current_route(), pool=g.db_pool.name)
+    return g.db
+
+
+def served_by(db_pool):
+    """Record a pool the current view's data came from, for conditional()."""
+    g.data_pools = g.get("data_pools", frozenset()) | {db_pool}
+
+
+def on_primary():
+    """Whether this request reads the primary, so its rows may fill shared caches."""
+    return g.get("db_pool") is pool
+
+
+@app.teardown_appcontext
+def release_db(exception):
+    conn = g.pop("db", None)
+    if conn is not None:
+        g.pop("db_pool", pool).putconn(conn)
+
+
+@app.after_request
+def remember_write(response):
+    """Pin the session to the primary for a while after it wrote something."""
+    if request.method == "POST" and not read_only_request() and response.status_code < 400:
+        session["wrote_at"] = time.time()
+    return response
+
+
+@contextmanager
+def db_cursor(row_factory=namedtuple_row, name=""):
+    """Cursor on the request connection, wrapped in its own transaction.
+
+    Passing a name opens a server-side cursor, which fetches rows in batches
+    of `itersize` while iterating instead of loading the whole result.
+    """
+    conn = get_db()
+    with conn.transaction():
+        with conn.cursor(name=name, row_factory=row_factory) as cur:
+            yield cur
+
+
+class LRUCache:
+    """Small thread-safe LRU cache with an optional time-to-live per entry."""
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            value, stored_at = entry
+            if self.ttl is not None and time.monotonic() - stored_at > self.ttl:
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic())
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+# Rendered data of consultation_details, keyed by (vat_doctor, consultation datetime).
+consultation_cache = LRUCache(
+    maxsize=app.config.get("CONSULTATION_CACHE_SIZE", 2048),
+    ttl=app.config.get("CONSULTATION_CACHE_TTL", 300),
+)
+
+
+class InProcessCacheBackend:
+    """Response cache and version stamps kept in this worker's memory.
+
+    Other workers learn about bumps through publish_invalidation().
+    """
+
+    shared = False
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.epoch = secrets.token_hex(4)  # ETags from a previous process never match
+        self._versions = {}
+        self._bodies = LRUCache(maxsize, ttl)
+        self._lock = threading.Lock()
+
+    def reset(self):
+        """Forget every stamp and page, e.g. after missing invalidations."""
+        with self._lock:
+            self.epoch = secrets.token_hex(4)
+            self._versions.clear()
+        self._bodies.clear()
+
+    def version(self, key):
+        return self._versions.get(key, 0)
+
+    def bump(self, key):
+        with self._lock:
+            self._versions[key] = self._versions.get(key, 0) + 1
+
+    def get(self, key):
+        return self._bodies.get(key)
+
+    def set(self, key, value):
+        self._bodies.set(key, value)
+
+
+class FileCacheBackend:
+    """Response cache and version stamps in a directory shared by workers.
+
+    Stands in for a shared cache server: versions are small counter files
+    updated under flock, bodies are written atomically and expire after ttl.
+    Expired bodies, and the oldest beyond `maxsize`, are pruned from set().
+    """
+
+    shared = True
+    PRUNE_INTERVAL = 60
+
+    def __init__(self, directory, maxsize=1024, ttl=None):
+        self.directory = directory
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._pruned_at = 0.0
+        os.makedirs(os.path.join(directory, "versions"), exist_ok=True)
+        os.makedirs(os.path.join(directory, "bodies"), exist_ok=True)
+        epoch_path = os.path.join(directory, "epoch")
+        if not os.path.exists(epoch_path):
+            with open(epoch_path, "w") as f:
+                f.write(secrets.token_hex(4))
+        with open(epoch_path) as f:
+            self.epoch = f.read().strip()
+
+    def _path(self, kind, key):
+        return os.path.join(self.directory, kind, hashlib.sha1(key.encode()).hexdigest())
+
+    def version(self, key):
+        try:
+            with open(self._path("versions", key)) as f:
+                return int(f.read() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def bump(self, key):
+        with open(self._path("versions", key), "a+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            version = int(f.read() or 0) + 1
+            f.seek(0)
+            f.truncate()
+            f.write(str(version))
+
+    def reset(self):
+        pass  # versions are shared, so no bump was missed
+
+    def get(self, key):
+        path = self._path("bodies", key)
+        try:
+            if self.ttl is not None and time.time() - os.path.getmtime(path) > self.ttl:
+                os.remove(path)
+                return None
+            with open(path, "rb") as f:
+                mimetype, _, body = f.read().partition(b"\n")
+            return mimetype.decode(), body
+        except FileNotFoundError:
+            return None
+
+    def set(self, key, value):
+        mimetype, body = value
+        path = self._path("bodies", key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(mimetype.encode() + b"\n" + body)
+        os.replace(tmp_path, path)
+        if time.time() - self._pruned_at > self.PRUNE_INTERVAL:
+            self._prune()
+
+    def _prune(self):
+        self._pruned_at = time.time()
+        bodies = []
+        for entry in os.scandir(os.path.join(self.directory, "bodies")):
+            try:
+                bodies.append((entry.stat().st_mtime, entry.path))
+            except FileNotFoundError:
+                continue  # removed by another worker
+        bodies.sort(reverse=True)
+        for i, (mtime, path) in enumerate(bodies):
+            if i >= self.maxsize or (self.ttl is not None and self._pruned_at - mtime > self.ttl):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+
+# FLASK_RESPONSE_CACHE_DIR switches to the file backend shared by all workers.
+if app.config.get("RESPONSE_CACHE_DIR"):
+    response_cache = FileCacheBackend(
+        app.config["RESPONSE_CACHE_DIR"],
+        maxsize=app.config.get("RESPONSE_CACHE_SIZE", 1024),
+        ttl=app.config.get("RESPONSE_CACHE_TTL", 3600),
+    )
+else:
+    response_cache = InProcessCacheBackend(
+        maxsize=app.config.get("RESPONSE_CACHE_SIZE", 1024),
+        ttl=app.config.get("RESPONSE_CACHE_TTL", 3600),
+    )
+
+
+# Each worker keeps its own caches; after a write it tells the others which
+# entries to drop on this channel, heard by the listener thread (ReferenceData).
+CACHE_CHANNEL = "cache_invalidation"
+worker_id = secrets.token_hex(4)
+
+
+def publish_invalidation(**message):
+    """NOTIFY the other workers; sent at commit when inside a transaction."""
+    payload = json.dumps({"sender": worker_id, **message})
+    if has_app_context() and "db" in g and g.get("db_pool") is pool:
+        g.db.execute("SELECT pg_notify(%s, %s);", (CACHE_CHANNEL, payload))
+    else:
+        ensure_pools_open()
+        with pool.connection() as conn:
+            conn.execute("SELECT pg_notify(%s, %s);", (CACHE_CHANNEL, payload))
+
+
+def apply_invalidation(payload):
+    """Drop what another worker's publish_invalidation() names."""
+    message = json.loads(payload)
+    if message.get("sender") == worker_id:
+        return  # already dropped when published
+    for key in message.get("versions", ()):
+        response_cache.bump(key)
+    for vat_doctor, consultation_date in message.get("consultations", ()):
+        consultation_cache.invalidate((vat_doctor, datetime.fromisoformat(consultation_date)))
+
+
+def bump_versions(*keys):
+    """Invalidate every cached response, in every worker, that depends on one of `keys`."""
+    for key in keys:
+        response_cache.bump(key)
+    if not response_cache.shared:
+        publish_invalidation(versions=list(keys))
+
+
+def version_etag(full_path, version_keys, kwargs, time_bucket=None):
+    """ETag of the page at `full_path` from the version stamps it depends on."""
+    stamps = [f"{key.format(**kwargs)}={response_cache.version(key.format(**kwargs))}" for key in version_keys]
+    if time_bucket:
+        stamps.append(f"time={int(time.time() // time_bucket)}")
+    return hashlib.sha1("|".join([response_cache.epoch, full_path, *stamps]).encode()).hexdigest()
+
+
+def conditional(*version_keys, time_bucket=None):
+    """Answer GETs with ETags derived from data version stamps.
+
+    `version_keys` are format strings filled from the view arguments, e.g.
+    "appointments:{vat}". A matching If-None-Match gets a 304 without running
+    the view; otherwise a stored copy of the page is served if one exists.
+    Pages that also depend on the clock pass `time_bucket` (seconds), which
+    ends the ETag's validity when the current bucket does.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(**kwargs):
+            if request.method != "GET" or "_flashes" in session:
+                return view(**kwargs)
+            etag = version_etag(request.full_path, version_keys, kwargs, time_bucket)
+            if etag in request.if_none_match:
+                response = Response(status=304)
+            else:
+                cached = response_cache.get(etag)
+                if cached is not None:
+                    mimetype, body = cached
+                    response = Response(body, mimetype=mimetype)
+                else:
+                    response = make_response(view(**kwargs))
+                    # A lagging replica may not have the write that bumped
+                    # the version yet, so only pages built from primary data are cached
+                    if response.status_code != 200 or g.get("data_pools") != {pool}:
+                        return response
+                    if not response.is_streamed:
+                        response_cache.set(etag, (response.mimetype, response.get_data()))
+            response.set_etag(etag)
+            response.headers["Cache-Control"] = "no-cache"
+            return response
+        return wrapper
+    return decorator
+
+
+class TimestampConverter(BaseConverter):
+    """`<timestamp:...>` URL parts, parsed from ISO 8601 into a datetime.
+
+    Consultations are cached and versioned by this value, so every spelling
+    of the same timestamp ("2024-05-01T10:00", "2024-05-01 10:00:00") maps to
+    the same entries. Malformed timestamps are a 404.
+    """
+
+    def to_python(self, value):
+        try:
+            return datetime.fromisoformat(value)
+        except ValueError:
+            raise ValidationError()
+
+
+app.url_map.converters["timestamp"] = TimestampConverter
+
+
+def consultation_changed(vat_doctor, consultation_date):
+    """Drop cached data and pages of a consultation, in every worker, after a write."""
+    keys = [f"consultation:{vat_doctor}:{consultation_date}", "consultations"]
+    consultation_cache.invalidate((vat_doctor, consultation_date))
+    for key in keys:
+        response_cache.bump(key)
+    publish_invalidation(
+        consultations=[[vat_doctor, consultation_date.isoformat()]], versions=[] if response_cache.shared else keys
+    )
+
+
+class QueryRegistry:
+    """The hot SQL of the app, each statement held once under a name.
+
+    Statements run through execute() are sent with prepare=True, so every
+    pooled connection parses and plans them once and afterwards only binds
+    and executes. The first run of a statement on a connection is timed as
+    the "prepare" phase and later runs as "execute", which /metrics reports
+    per statement. Set FLASK_PREPARED_STATEMENTS=false behind a transaction
+    pooler that cannot keep prepared statements.
+    """
+
+    def __init__(self):
+        self._statements = {}
+        self._prepared = weakref.WeakKeyDictionary()
+
+    def register(self, name, statement):
+        if name in self._statements:
+            raise ValueError(f"Query {name!r} is already registered")
+        self._statements[name] = statement
+        return statement
+
+    def execute(self, cur, name, params=None):
+        prepared = self._prepared.setdefault(cur.connection, set())
+        phase = "execute" if name in prepared else "prepare"
+        started = time.perf_counter()
+        cur.execute(self._statements[name], params, prepare=app.config.get("PREPARED_STATEMENTS", True))
+        metrics.observe("db_statement_seconds", time.perf_counter() - started, statement=name, phase=phase)
+        prepared.add(name)
+        return cur
+
+    def __iter__(self):
+        return iter(self._statements.items())
+
+
+queries = QueryRegistry()
+
+
+class ReferenceData:
+    """Versioned in-process copy of the diagnostic_code and medication tables.
+
+    Each table is loaded once into a list (for the form dropdowns) plus a hash
+    lookup, and kept until its TTL expires or it is invalidated. Writers call
+    notify_reference_change(), and every worker's listener thread receives the
+    NOTIFY and drops its copy, so changes propagate across processes. The same
+    thread hears the facts ETL announce new facts (see facts_loaded) and other
+    workers' cache invalidations (see publish_invalidation).
+    """
+
+    CHANNEL = "reference_data"
+
+    def __init__(self, ttl):
+        self.version = 0
+        self._tables = LRUCache(maxsize=8, ttl=ttl)
+        self._listener = None
+        self._listener_lock = threading.Lock()
+
+    def diagnostic_codes(self):
+        """Return (rows, {description: ID})."""
+        cached = self._tables.get("diagnostic_code")
+        if cached is None:
+            with db_cursor() as cur:
+                rows = cur.execute(
+                    """
+                    SELECT ID, description
+                    FROM diagnostic_code
+                    ORDER BY description
+                    """
+                ).fetchall()
+            cached = (rows, {row.description: row.id for row in rows})
+            self._tables.set("diagnostic_code", cached)
+        return cached
+
+    def medications(self):
+        """Return (rows, {(name, lab)})."""
+        cached = self._tables.get("medication")
+        if cached is None:
+            with db_cursor() as cur:
+                rows = cur.execute(
+                    """
+                    SELECT name, lab
+                    FROM medication
+                    ORDER BY name, lab
+                    """
+                ).fetchall()
+            cached = (rows, frozenset((row.name, row.lab) for row in rows))
+            self._tables.set("medication", cached)
+        return cached
+
+    def invalidate(self, table=None):
+        if table:
+            self._tables.invalidate(table)
+        else:
+            self._tables.clear()
+        self.version += 1
+
+    def start_listener(self):
+        """Start the LISTEN thread for this process, once."""
+        if self._listener is not None and self._listener.is_alive():
+            return
+        with self._listener_lock:
+            if self._listener is None or not self._listener.is_alive():
+                self._listener = threading.Thread(target=self._listen, name="reference-data-listener", daemon=True)
+                self._listener.start()
+
+    def _listen(self):
+        conninfo = app.config.get("DATABASE_URL", DATABASE_URL)
+        while True:
+            try:
+                with psycopg.connect(conninfo, autocommit=True) as conn:
+                    conn.execute(f"LISTEN {self.CHANNEL};")
+                    conn.execute(f"LISTEN {FACTS_CHANNEL};")
+                    conn.execute(f"LISTEN {CACHE_CHANNEL};")
+                    # Anything may have changed while we were not listening
+                    self.invalidate()
+                    response_cache.reset()
+                    consultation_cache.clear()
+                    facts_loaded()
+                    for notify in conn.notifies():
+                        if notify.channel == FACTS_CHANNEL:
+                            facts_loaded()
+                        elif notify.channel == CACHE_CHANNEL:
+                            apply_invalidation(notify.payload)
+                        else:
+                            self.invalidate(notify.payload or None)
+            except psycopg.Error as e:
+                log.warning(f"Reference data listener lost its connection: {e}")
+                time.sleep(5)
+
+
+def notify_reference_change(cur, table):
+    """Tell every worker that `table` changed, once the transaction commits."""
+    cur.execute("SELECT pg_notify(%s, %s);", (ReferenceData.CHANNEL, table))
+    reference_data.invalidate(table)
+
+
+reference_data = ReferenceData(ttl=app.config.get("REFERENCE_DATA_TTL", 3600))
+
+
+@app.before_request
+def start_cache_listener():
+    """Every cache a view reads is kept fresh by the listener thread, so start it first."""
+    reference_data.start_listener()
+
+
+def warm_up():
+    """Pay the first-request costs before the worker accepts traffic.
+
+    Compiles every template, fills the pools to FLASK_POOL_MIN_SIZE and
+    loads the reference data, then logs how long it took.
+    """
+    started = time.perf_counter()
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+    open_pools(wait=True, timeout=app.config.get("POOL_TIMEOUT", 10))
+    with app.app_context():
+        reference_data.start_listener()
+        reference_data.diagnostic_codes()
+        reference_data.medications()
+    startup_times["warm_up"] = time.perf_counter() - started
+    log.info(f"Worker warmed up in {startup_times['warm_up'] * 1000:.0f} ms.")
+
+
+def create_app():
+    """Return the app warmed up; the entry point to serve it from.
+
+    The app, its (closed) pools and caches are defined at import, which is
+    cheap. Serve `app:create_app()`, e.g. `gunicorn 'app:create_app()'` or
+    `flask --app 'app:create_app()' run`, so each worker runs warm_up() once
+    before taking traffic, unless FLASK_WARM_UP is false. Serving the bare
+    `app:app` works too, but the pools then open and templates compile
+    lazily on the first requests.
+    """
+    if not app.extensions.get("clinic_started"):
+        if app.config.get("WARM_UP", True):
+            warm_up()
+        app.extensions["clinic_started"] = True
+    return app
+
+
+@app.cli.command("migrate")
+def migrate():
+    """Apply SCHEMA_MIGRATIONS to the database."""
+    ensure_pools_open()
+    with pool.connection() as conn:
+        for statement in SCHEMA_MIGRATIONS:
+            conn.execute(statement)
+    log.info(f"Applied {len(SCHEMA_MIGRATIONS)} schema statements.")
+
+
+@app.route("/metrics", methods=("GET",))
+def metrics_endpoint():
+    """Prometheus text exposition of the request, query and pool metrics."""
+    pool_lines = [f"db_pool_{key} {value}" for key, value in sorted(pool.get_stats().items())]
+    pool_lines += [f'app_startup_seconds{{phase="{phase}"}} {value}' for phase, value in startup_times.items()]
+    for replica in replica_pools:
+        pool_lines += [f'db_pool_{key}{{pool="{replica.name}"}} {value}' for key, value in sorted(replica.get_stats().items())]
+        pool_lines.append(f'db_replica_lag_seconds{{pool="{replica.name}"}} {router.lag(replica)}')
+    return Response(metrics.render() + "\n".join(pool_lines) + "\n", mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/pool_stats", methods=("GET",))
+def pool_stats():
+    stats = pool.get_stats()
+    if replica_pools:
+        stats["replicas"] = {
+            replica.name: {**replica.get_stats(), "lag_seconds": router.lag(replica)} for replica in replica_pools
+        }
+    return jsonify(stats)
+
 @app.route("/", methods=("GET",))
 
 def homepage():
@@ -43,48 +1076,72 @@ def homepage():
 
 
 
+CLIENT_SEARCH_FIELDS = ("vat", "name", "city", "street", "zip")
+
+
+def build_client_search(criteria, after=None, limit=50):
+    """Compose the client search from only the fields that were filled in.
+
+    VAT is an exact (primary key) lookup; the text fields use LIKE, which the
+    pg_trgm indexes created by `flask migrate` can serve. Results are ordered by
+    (name, VAT) and paginated by keyset on that pair.
+    """
+    conditions = []
+    params = {"limit": limit}
+    for field in CLIENT_SEARCH_FIELDS:
+        value = criteria.get(field)
+        if not value:
+            continue
+        if field == "vat":
+            conditions.append(sql.SQL("VAT = {}").format(sql.Placeholder(field)))
+            params[field] = value
+        else:
+            conditions.append(sql.SQL("{} LIKE {}").format(sql.Identifier(field), sql.Placeholder(field)))
+            params[field] = f"%{value}%"
+    if after is not None:
+        conditions.append(sql.SQL("(name, VAT) > (%(after_name)s, %(after_vat)s)"))
+        params["after_name"], params["after_vat"] = after
+
+    query = sql.SQL(
+        """
+        SELECT name, VAT
+        FROM client
+        WHERE {}
+        ORDER BY name ASC, VAT ASC
+        LIMIT %(limit)s;
+        """
+    ).format(sql.SQL(" AND ").join(conditions) if conditions else sql.SQL("TRUE"))
+    return query, params
+
+
 @app.route("/search_clients", methods=("GET","POST"))
+@read_only
 def search_clients():
-    """Show all the clients, alphabetical order."""
-    
-    vat = request.form.get('vat') if request.form.get('vat') else 'MISSING'
-    name = request.form.get('name') if request.form.get('name') else 'MISSING'
-    city = request.form.get('city') if request.form.get('city') else 'MISSING'
-    zip_code = request.form.get('zip') if request.form.get('zip') else 'MISSING'
-    street = request.form.get('street') if request.form.get('street') else 'MISSING'
-    
-    if vat != 'MISSING' or name != 'MISSING' or city != 'MISSING' or zip_code != 'MISSING' or street != 'MISSING':
-        
-        with psycopg.connect(conninfo=DATABASE_URL) as conn:
-            with conn.cursor(row_factory=namedtuple_row) as cur:
-                clients = cur.execute(
-                    """
-                    SELECT name, VAT
-                    FROM client 
-                    WHERE     
-                        (name LIKE %(name)s OR %(name_na)s = 'MISSING' ) AND 
-                        (vat = %(vat)s OR %(vat)s ='MISSING') AND 
-                        (city LIKE %(city)s OR %(city_na)s = 'MISSING') AND 
-                        (street LIKE %(street)s OR %(street_na)s = 'MISSING') AND
-                        (zip LIKE %(zip)s OR %(zip_na)s = 'MISSING')
-                    ORDER BY name ASC;
-                    """,
-                    {
-                        "vat": vat,
-                        "name": f'%{name}%',
-                        "city": f'%{city}%',
-                        "street": f'%{street}%',
-                        "zip": f'%{zip_code}%',
-                        "name_na": name,
-                        "street_na": street,
-                        "zip_na": zip_code,
-                        "city_na": city,
-                    },
-                ).fetchall()
-                log.debug(f"Found {cur.rowcount} rows.")
+    """Show the matching clients, alphabetical order, one page at a time."""
+    criteria = {field: request.values.get(field, "").strip() for field in CLIENT_SEARCH_FIELDS}
+    criteria = {field: value for field, value in criteria.items() if value}
+    after = None
+    if request.values.get("after_name") is not None and request.values.get("after_vat"):
+        after = (request.values["after_name"], request.values["after_vat"])
+    page_size = app.config.get("SEARCH_PAGE_SIZE", 50)
+
+    if criteria:
+        query, params = build_client_search(criteria, after, page_size + 1)
+        with db_cursor() as cur:
+            clients = cur.execute(query, params).fetchall()
+            log.debug(f"Found {cur.rowcount} rows.")
+
+        next_page = None
+        if len(clients) > page_size:
+            clients = clients[:page_size]
+            next_page = url_for(
+                "search_clients", **criteria, after_name=clients[-1].name, after_vat=clients[-1].vat
+            )
 
         if len(clients)>0:
-            return render_template("search_clients.html", vat=vat,clients=clients)
+            return render_template(
+                "search_clients.html", vat=criteria.get("vat"), clients=clients, next_page=next_page
+            )
         else:
             flash("No clients found.") 
     else:
@@ -107,18 +1164,17 @@ def new_client():
     new_client = None  # Initialize new_client outside the try block
 
     try:
-        with psycopg.connect(conninfo=DATABASE_URL) as conn:
-            with conn.cursor(row_factory=namedtuple_row) as cur:
-                new_client = cur.execute(
-                    """
-                    INSERT INTO client 
-                    VALUES (%(VAT)s, %(name)s, %(birth_date)s, %(street)s, %(city)s, %(zip)s, %(gender)s) 
-                    RETURNING *;  -- Return the inserted row
-                    """,
-                    {"VAT": VAT, "name": name, "birth_date": birth_date, "street": street, "city": city, "zip": zip,
-                        "gender": gender},
-                ).fetchone()
-                log.debug(f"Found {cur.rowcount} rows.")
+        with db_cursor() as cur:
+            new_client = cur.execute(
+                """
+                INSERT INTO client 
+                VALUES (%(VAT)s, %(name)s, %(birth_date)s, %(street)s, %(city)s, %(zip)s, %(gender)s) 
+                RETURNING *;  -- Return the inserted row
+                """,
+                {"VAT": VAT, "name": name, "birth_date": birth_date, "street": street, "city": city, "zip": zip,
+                    "gender": gender},
+            ).fetchone()
+            log.debug(f"Found {cur.rowcount} rows.")
         flash("New client added successfully.")
     except UniqueViolation:
         flash("Client already exists")
@@ -129,211 +1185,720 @@ def new_client():
     return render_template("new_client.html", VAT=VAT, new_client=new_client, name=name, birth_date=birth_date,
                            street=street, city=city, zip=zip, gender=gender)
 
+CLIENT_COLUMNS = ("VAT", "name", "birth_date", "street", "city", "zip", "gender")
+
+
+def read_client_rows(stream, fmt):
+    """Yield (line, row dict) from a CSV (with header) or JSONL text stream."""
+    if fmt == "jsonl":
+        for line, text in enumerate(stream, start=1):
+            if text.strip():
+                try:
+                    yield line, json.loads(text)
+                except json.JSONDecodeError as e:
+                    yield line, {"__error__": f"invalid JSON: {e.msg}"}
+    else:
+        for line, row in enumerate(csv.DictReader(stream), start=2):
+            yield line, row
+
+
+def validate_client_row(row):
+    """Return the client tuple in CLIENT_COLUMNS order, or raise ValueError."""
+    if not isinstance(row, dict):
+        raise ValueError("row must be a JSON object")
+    if "__error__" in row:
+        raise ValueError(row["__error__"])
+    if None in row:
+        raise ValueError("more fields than the header")  # csv.DictReader's restkey
+    for key, value in row.items():
+        if value is not None and (isinstance(value, bool) or not isinstance(value, (str, int, float))):
+            raise ValueError(f"{key} must be a string or a number")
+    row = {str(key).strip().lower(): (value.strip() if isinstance(value, str) else value) for key, value in row.items()}
+    if not row.get("vat"):
+        raise ValueError("missing VAT")
+    if not row.get("name"):
+        raise ValueError("missing name")
+    try:
+        datetime.strptime(row.get("birth_date") or "", "%Y-%m-%d")
+    except ValueError:
+        raise ValueError("birth_date must be YYYY-MM-DD") from None
+    return tuple(row.get(column.lower()) or None for column in CLIENT_COLUMNS)
+
+
+def import_clients(rows, batch_size=50000):
+    """Bulk-load clients with COPY through a staging table.
+
+    Invalid rows and VATs that already exist are reported per line instead
+    of aborting the batch. Each batch of `batch_size` rows is one transaction.
+    A batch holding a row the database rejects (e.g. a value too long for
+    its column) is retried row by row, each in a savepoint, so only that
+    row is reported invalid.
+    """
+    report = {"inserted": 0, "invalid": [], "conflicts": []}
+    started = time.perf_counter()
+    batch = []
+
+    def flush():
+        try:
+            copy_batch()
+        except (psycopg.DataError, psycopg.IntegrityError):
+            insert_rows()
+        batch.clear()
+
+    def copy_batch():
+        with db_cursor() as cur:
+            cur.execute(
+                """
+                CREATE TEMP TABLE client_staging (LIKE client INCLUDING DEFAULTS, line int)
+                ON COMMIT DROP;
+                """
+            )
+            with cur.copy(
+                "COPY client_staging (VAT, name, birth_date, street, city, zip, gender, line) FROM STDIN"
+            ) as copy:
+                for line, values in batch:
+                    copy.write_row((*values, line))
+            inserted = cur.execute(
+                """
+                INSERT INTO client (VAT, name, birth_date, street, city, zip, gender)
+                SELECT DISTINCT ON (VAT) VAT, name, birth_date, street, city, zip, gender
+                FROM client_staging
+                ORDER BY VAT, line
+                ON CONFLICT DO NOTHING
+                RETURNING VAT;
+                """
+            ).fetchall()
+            inserted = {row.vat for row in inserted}
+            report["inserted"] += len(inserted)
+            seen = set()
+            for line, values in batch:
+                if values[0] in inserted and values[0] not in seen:
+                    seen.add(values[0])
+                else:
+                    report["conflicts"].append({"line": line, "vat": values[0], "error": "client already exists"})
+
+    def insert_rows():
+        with db_cursor() as cur:
+            for line, values in batch:
+                try:
+                    with cur.connection.transaction():
+                        inserted = cur.execute(
+                            """
+                            INSERT INTO client (VAT, name, birth_date, street, city, zip, gender)
+                            VALUES (%s, %s, %s, %s, %s, %s, %s)
+                            ON CONFLICT DO NOTHING
+                            RETURNING VAT;
+                            """,
+                            values
+                        ).fetchone()
+                except (psycopg.DataError, psycopg.IntegrityError) as e:
+                    report["invalid"].append({"line": line, "error": str(e).splitlines()[0]})
+                    continue
+                if inserted:
+                    report["inserted"] += 1
+                else:
+                    report["conflicts"].append({"line": line, "vat": values[0], "error": "client already exists"})
+
+    for line, row in rows:
+        try:
+            batch.append((line, validate_client_row(row)))
+        except ValueError as e:
+            report["invalid"].append({"line": line, "error": str(e)})
+        if len(batch) >= batch_size:
+            flush()
+    if batch:
+        flush()
+
+    elapsed = time.perf_counter() - started
+    report["seconds"] = round(elapsed, 3)
+    report["rows_per_second"] = round(report["inserted"] / elapsed) if elapsed else None
+    return report
+
+
+@app.route("/clients/import", methods=["POST"])
+def import_clients_upload():
+    """Import an uploaded CSV or JSONL file of clients."""
+    upload = request.files.get("file")
+    if upload is None:
+        return jsonify({"error": "upload a CSV or JSONL file in the 'file' field"}), 400
+    fmt = request.args.get("format") or ("jsonl" if upload.filename.endswith(".jsonl") else "csv")
+    stream = io.TextIOWrapper(upload.stream, encoding="utf-8", newline="")
+    try:
+        report = import_clients(read_client_rows(stream, fmt))
+    except UnicodeDecodeError:
+        return jsonify({"error": "the file must be UTF-8 text"}), 400
+    return jsonify(report)
+
+
+@app.route("/clients/export", methods=["GET"])
+@read_only
+def export_clients():
+    """Stream the client table as CSV with COPY TO."""
+    def generate():
+        with db_cursor() as cur:
+            with cur.copy("COPY client TO STDOUT WITH (FORMAT csv, HEADER true)") as copy:
+                for data in copy:
+                    yield bytes(data)
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/csv",
+        headers={"Content-Disposition": "attachment; filename=clients.csv"},
+    )
+
+
+@app.cli.command("import-clients")
+@click.argument("path", type=click.File("r", encoding="utf-8"))
+@click.option("--format", "fmt", type=click.Choice(["csv", "jsonl"]), default=None)
+@click.option("--batch-size", default=50000, show_default=True)
+def import_clients_command(path, fmt, batch_size):
+    """Bulk-import clients from a CSV or JSONL file."""
+    fmt = fmt or ("jsonl" if path.name.endswith(".jsonl") else "csv")
+    report = import_clients(read_client_rows(path, fmt), batch_size)
+    for problem in report["invalid"] + report["conflicts"]:
+        click.echo(f"line {problem['line']}: {problem['error']}", err=True)
+    click.echo(
+        f"Inserted {report['inserted']} clients in {report['seconds']}s "
+        f"({report['rows_per_second']} rows/s), {len(report['invalid'])} invalid, "
+        f"{len(report['conflicts'])} conflicts."
+    )
+
+
+# Appointments occupy [date_timestamp, date_timestamp + 1 hour) of the doctor's
+# time, stored in the generated appointment.slot range column.
+APPOINTMENT_LENGTH = timedelta(hours=1)
+
+
+BOOK_APPOINTMENT_QUERY = queries.register("book_appointment", """
+    INSERT INTO appointment (date_timestamp, VAT_doctor, VAT_client, description)
+    SELECT %(appointment_datetime)s, d.VAT, %(vat)s, %(description)s
+    FROM doctor d
+    WHERE d.VAT = %(doctor_vat)s
+    RETURNING VAT_doctor;
+""")
+
+
 @app.route("/appointments/<vat>", methods=["GET", "POST"])
 def new_appointment(vat):
-    # Assuming you have a variable 'doctors' containing the list of doctors for the dropdown
-
-    # with psycopg.connect(conninfo=DATABASE_URL) as conn:
-    #     with conn.cursor(row_factory=namedtuple_row) as cur:
-    #         doctors = cur.execute(
-    #             """
-    #             SELECT d.VAT, e.name
-    #             FROM doctor d
-    #             JOIN employee e on d.VAT = e.VAT;
-    #             """
-    #         ).fetchall()
-            
     if request.method == "POST":
         date = request.form.get('date')
         time = request.form.get('time')
         doctor_vat = request.form.get('doctorvat')
         description = request.form.get('description')
 
-        appointment_datetime = datetime.strptime(f"{date} {time}", "%Y-%m-%d %H:%M")
-        start_time = appointment_datetime - timedelta(hours=1)
-        end_time = appointment_datetime + timedelta(hours=1)
-        
-        with psycopg.connect(conninfo=DATABASE_URL) as conn:
-            with conn.cursor(row_factory=namedtuple_row) as cur:
-                # Check for overlapping appointments for the selected doctor
-                doc = cur.execute(
-                    """
-                    SELECT *
-                    FROM doctor
-                    WHERE VAT = %(doctor_vat)s
-                    """,
-                    {"doctor_vat": doctor_vat}
-                ).fetchall()
-        
-        if  doc:
-            with psycopg.connect(conninfo=DATABASE_URL) as conn:
-                with conn.cursor(row_factory=namedtuple_row) as cur:
-                    # Check for overlapping appointments for the selected doctor
-                    overlapping_appointments = cur.execute(
-                        """
-                        SELECT d.VAT, e.name AS doctor_name
-                        FROM appointment a
-                        JOIN doctor d ON a.VAT_doctor = d.VAT
-                        JOIN employee e ON e.VAT = d.VAT
-                        WHERE d.VAT = %(doctor_vat)s AND date_timestamp BETWEEN %(start_time)s AND %(end_time)s;
-                        """,
-                        {"doctor_vat": doctor_vat, "start_time": start_time, "end_time": end_time}
-                    ).fetchall()
+        try:
+            appointment_datetime = datetime.strptime(f"{date} {time}", "%Y-%m-%d %H:%M")
+        except ValueError:
+            flash("Invalid date or time.")
+            return render_template("new_appointment.html", vat=vat)
 
-            if overlapping_appointments:
-                flash("Overlapping appointments for the selected doctor. Choose a different time.")
-            else:
-                # Insert the new appointment into the 'appointment' table
-                
-                flash(doctor_vat)
-                with psycopg.connect(conninfo=DATABASE_URL) as conn:
-                    with conn.cursor(row_factory=namedtuple_row) as cur:
-                        cur.execute(
-                            """
-                            INSERT INTO appointment (date_timestamp, VAT_doctor, VAT_client, description)
-                            VALUES (%(appointment_datetime)s, %(doctor_vat)s, %(vat)s, %(description)s);
-                            """,
-                            {
-                                "appointment_datetime": appointment_datetime,
-                                "doctor_vat": doctor_vat,
-                                "vat": vat,
-                                "description": description,
-                            }
-                        )
-                        conn.commit()
-                
-                flash("New appointment registered successfuly!")
-                return render_template("new_appointment.html",VAT=vat)
+        # The doctor check and the insert are one statement; overlaps are
+        # rejected by the appointment_no_overlap exclusion constraint.
+        try:
+            with db_cursor() as cur:
+                booked = queries.execute(
+                    cur, "book_appointment",
+                    {
+                        "appointment_datetime": appointment_datetime,
+                        "doctor_vat": doctor_vat,
+                        "vat": vat,
+                        "description": description,
+                    }
+                ).fetchone()
+        except (ExclusionViolation, UniqueViolation):
+            flash("Overlapping appointments for the selected doctor. Choose a different time.")
+            return render_template("new_appointment.html", vat=vat)
+
+        if booked:
+            bump_versions(f"appointments:{vat}", "appointments")
+            flash("New appointment registered successfuly!")
+            return render_template("new_appointment.html", VAT=vat, vat=vat)
         else:
             flash("Incorrect Doctor VAT inserted")
-            return render_template("new_appointment.html")
+            return render_template("new_appointment.html", vat=vat)
         
-    return render_template("new_appointment.html")
+    return render_template("new_appointment.html", vat=vat)
+
+AVAILABLE_DOCTORS_QUERY = queries.register("available_doctors", """
+    SELECT d.VAT, e.name
+    FROM doctor d
+    JOIN employee e on d.VAT = e.VAT
+    WHERE NOT EXISTS (
+        SELECT 1
+        FROM appointment a
+        WHERE a.VAT_doctor = d.VAT AND a.slot && tsrange(%(start_time)s, %(end_time)s)
+    );
+""")
+
 
 @app.route("/available_doctors", methods=["GET", "POST"])
+@read_only
+@conditional("appointments")
 def available_doctors():
-    if request.method == "POST":
-        date = request.form.get('date')
-        time = request.form.get('time')
+    # Also answers GET ?date=&time= so results can be revalidated with ETags
+    if request.method == "POST" or "date" in request.args:
+        date = request.values.get('date')
+        time = request.values.get('time')
 
-        selected_datetime = datetime.strptime(f"{date} {time}", "%Y-%m-%d %H:%M")
-        start_time = selected_datetime - timedelta(hours=1)
-        end_time = selected_datetime + timedelta(hours=1)
+        try:
+            start_time = datetime.strptime(f"{date} {time}", "%Y-%m-%d %H:%M")
+        except ValueError:
+            flash("Invalid date or time.")
+            return render_template("available_doctors.html")
+        end_time = start_time + APPOINTMENT_LENGTH
 
         # Query the database to find available doctors for the selected date and time
-        with psycopg.connect(conninfo=DATABASE_URL) as conn:
-            with conn.cursor(row_factory=namedtuple_row) as cur:
-                available_doctors = cur.execute(
-                    """
-                    SELECT d.VAT, e.name
-                    FROM doctor d
-                    JOIN employee e on d.VAT = e.VAT
-                    WHERE d.VAT NOT IN (
-                        SELECT a.VAT_doctor
-                        FROM appointment a
-                        WHERE date_timestamp BETWEEN %(start_time)s AND %(end_time)s
-                    );
-                    """,
-                    {"start_time": start_time, "end_time": end_time}
-                ).fetchall()
+        with db_cursor() as cur:
+            available_doctors = queries.execute(
+                cur, "available_doctors",
+                {"start_time": start_time, "end_time": end_time}
+            ).fetchall()
 
         return render_template("available_doctors.html", date=date, time=time, available_doctors=available_doctors)
 
     return render_template("available_doctors.html")
 
-@app.route("/client/<vat>/appointments", methods=["GET"])
-def client_appointments(vat):
-    # Query the database to retrieve detailed information about appointments for the selected client
-    current_time = datetime.now()
+queries.register("free_slots", """
+    SELECT d.VAT, e.name, s.slot_start
+    FROM generate_series(
+        %(start)s::timestamp, %(end)s::timestamp - %(length)s, %(length)s
+    ) AS s(slot_start)
+    CROSS JOIN doctor d
+    JOIN employee e ON e.VAT = d.VAT
+    WHERE EXTRACT(HOUR FROM s.slot_start) >= %(open_hour)s
+      AND EXTRACT(HOUR FROM s.slot_start) < %(close_hour)s
+      AND NOT EXISTS (
+        SELECT 1
+        FROM appointment a
+        WHERE a.VAT_doctor = d.VAT
+          AND a.slot && tsrange(s.slot_start, s.slot_start + %(length)s)
+      )
+    ORDER BY d.VAT, s.slot_start;
+""")
+
+
+@app.route("/api/free_slots", methods=["GET"])
+@read_only
+def free_slots():
+    """Free one-hour slots of every doctor over `days` days from `date`."""
+    try:
+        start_day = datetime.strptime(request.args.get("date", ""), "%Y-%m-%d")
+    except ValueError:
+        return jsonify({"error": "date must be YYYY-MM-DD"}), 400
+    days = max(1, min(request.args.get("days", 1, type=int), 7))
+
+    with db_cursor() as cur:
+        slots = queries.execute(
+            cur, "free_slots",
+            {
+                "start": start_day,
+                "end": start_day + timedelta(days=days),
+                "length": APPOINTMENT_LENGTH,
+                "open_hour": app.config.get("CLINIC_OPEN_HOUR", 9),
+                "close_hour": app.config.get("CLINIC_CLOSE_HOUR", 17),
+            },
+        ).fetchall()
+
+    doctors = {}
+    for slot in slots:
+        doctor = doctors.setdefault(slot.vat, {"vat": slot.vat, "name": slot.name, "free_slots": []})
+        doctor["free_slots"].append(slot.slot_start.isoformat())
+    return jsonify(list(doctors.values()))
+
+
+# One statement books a whole batch: doctors are checked with a join and
+# overlaps, with the table and within the batch, are skipped by
+# ON CONFLICT DO NOTHING on the appointment_no_overlap exclusion constraint.
+queries.register("book_appointments", """
+    WITH requested AS (
+        SELECT *
+        FROM unnest(%(slot_nos)s::int[], %(doctors)s::text[], %(starts)s::timestamp[], %(descriptions)s::text[])
+            AS r(slot_no, VAT_doctor, date_timestamp, description)
+    ),
+    booked AS (
+        INSERT INTO appointment (date_timestamp, VAT_doctor, VAT_client, description)
+        SELECT r.date_timestamp, d.VAT, %(vat)s, r.description
+        FROM requested r
+        JOIN doctor d ON d.VAT = r.VAT_doctor
+        ORDER BY r.slot_no
+        ON CONFLICT DO NOTHING
+        RETURNING VAT_doctor, date_timestamp
+    )
+    SELECT r.slot_no,
+           CASE
+               WHEN b.VAT_doctor IS NOT NULL THEN 'booked'
+               WHEN NOT EXISTS (SELECT 1 FROM doctor d WHERE d.VAT = r.VAT_doctor) THEN 'invalid_doctor'
+               ELSE 'conflict'
+           END AS status
+    FROM requested r
+    LEFT JOIN booked b ON b.VAT_doctor = r.VAT_doctor AND b.date_timestamp = r.date_timestamp
+    ORDER BY r.slot_no;
+""")
+
+
+def expand_bookings(bookings):
+    """Expand batch entries into one result per requested slot.
+
+    Each entry is {"doctor_vat", "date": "YYYY-MM-DD", "time": "HH:MM",
+    "description", "repeat": N, "every_days": 7}; `repeat` books the same
+    time N times, `every_days` apart (weekly by default). Slots that cannot
+    be parsed get status "invalid" here and never reach the database.
+    """
+    results, requested = [], set()
+    for entry_index, entry in enumerate(bookings):
+        try:
+            start = datetime.strptime(f"{entry['date']} {entry['time']}", "%Y-%m-%d %H:%M")
+            repeat = int(entry.get("repeat", 1))
+            every = timedelta(days=int(entry.get("every_days", 7)))
+            if not 1 <= repeat <= 52 or every <= timedelta(0) or not entry.get("doctor_vat"):
+                raise ValueError
+        except (KeyError, TypeError, ValueError):
+            results.append({"entry": entry_index, "status": "invalid"})
+            continue
+        for occurrence in range(repeat):
+            slot = (str(entry["doctor_vat"]), start + occurrence * every)
+            results.append(
+                {
+                    "entry": entry_index,
+                    "occurrence": occurrence,
+                    "doctor_vat": slot[0],
+                    "date_timestamp": slot[1],
+                    "description": entry.get("description"),
+                    # The same slot twice in a batch: only the first can be booked
+                    "status": "conflict" if slot in requested else None,
+                }
+            )
+            requested.add(slot)
+    return results
+
+
+@app.route("/api/appointments/<vat>/batch", methods=["POST"])
+def book_appointments(vat):
+    """Book many appointments, including recurring series, for one client.
+
+    Expects JSON {"appointments": [...], "atomic": false} (entries as in
+    expand_bookings) and returns one result per slot: booked, conflict,
+    invalid_doctor or invalid. With "atomic", nothing is booked unless every
+    slot can be, and the slots that could have been are reported not_booked.
+    """
+    body = request.get_json(silent=True) or {}
+    bookings = body.get("appointments")
+    if not isinstance(bookings, list) or not all(isinstance(entry, dict) for entry in bookings):
+        return jsonify({"error": "appointments must be a list of objects"}), 400
+    results = expand_bookings(bookings)
+    if len(results) > app.config.get("BATCH_BOOKING_MAX", 500):
+        return jsonify({"error": "too many slots in one batch"}), 413
+    slot_nos = [i for i, result in enumerate(results) if result["status"] is None]
 
-    with psycopg.connect(conninfo=DATABASE_URL) as conn:
-        with conn.cursor(row_factory=namedtuple_row) as cur:
-            appointments = cur.execute(
-                """
-                SELECT
-                    a.date_timestamp,
-                    e.name AS doctor_name,
-                    a.VAT_doctor as vat_doctor,
-                    a.description,
-                    CASE
-                        WHEN c.date_timestamp IS NOT NULL THEN 'Attended'
-                        WHEN a.date_timestamp > %(current_time)s THEN 'Scheduled'
-                        ELSE 'Not Attended'
-                    END AS attended
-                FROM appointment a
-                JOIN employee e ON e.VAT = a.VAT_doctor
-                LEFT JOIN doctor d ON a.VAT_doctor = d.VAT
-                LEFT JOIN consultation c ON a.date_timestamp = c.date_timestamp  AND a.VAT_doctor = c.VAT_doctor
-                WHERE a.VAT_client = %(vat)s
-                ORDER BY a.date_timestamp DESC;
-                """,
-                {"vat": vat, "current_time": current_time}
+    try:
+        with db_cursor() as cur:
+            rows = queries.execute(
+                cur, "book_appointments",
+                {
+                    "vat": vat,
+                    "slot_nos": slot_nos,
+                    "doctors": [results[i]["doctor_vat"] for i in slot_nos],
+                    "starts": [results[i]["date_timestamp"] for i in slot_nos],
+                    "descriptions": [results[i]["description"] for i in slot_nos],
+                }
             ).fetchall()
+            for row in rows:
+                results[row.slot_no]["status"] = row.status
+            failed = any(result["status"] != "booked" for result in results)
+            if body.get("atomic") and failed:
+                for result in results:
+                    if result["status"] == "booked":
+                        result["status"] = "not_booked"
+                raise psycopg.Rollback()
+    except ForeignKeyViolation:
+        return jsonify({"error": "no such client"}), 404
+
+    booked = sum(result["status"] == "booked" for result in results)
+    if booked:
+        bump_versions(f"appointments:{vat}", "appointments")
+    for result in results:
+        result.pop("description", None)
+        if "date_timestamp" in result:
+            result["date_timestamp"] = result["date_timestamp"].isoformat()
+    return jsonify({"vat": vat, "booked": booked, "results": results}), 201 if booked else 200
+
+# Upcoming appointments (nearest first) and past ones (latest first), each
+# keyset-paginated and read from the (VAT_client, date_timestamp DESC) index.
+CLIENT_APPOINTMENTS_QUERY = queries.register("client_appointments", """
+    (
+        SELECT
+            a.date_timestamp,
+            e.name AS doctor_name,
+            a.VAT_doctor as vat_doctor,
+            a.description,
+            'Scheduled' AS attended,
+            'upcoming' AS slice
+        FROM appointment a
+        JOIN employee e ON e.VAT = a.VAT_doctor
+        WHERE a.VAT_client = %(vat)s
+          AND a.date_timestamp > GREATEST(%(current_time)s::timestamp, %(after)s::timestamp)
+        ORDER BY a.date_timestamp ASC
+        LIMIT %(upcoming_limit)s
+    )
+    UNION ALL
+    (
+        SELECT
+            a.date_timestamp,
+            e.name AS doctor_name,
+            a.VAT_doctor as vat_doctor,
+            a.description,
+            CASE WHEN c.date_timestamp IS NOT NULL THEN 'Attended' ELSE 'Not Attended' END AS attended,
+            'past' AS slice
+        FROM appointment a
+        JOIN employee e ON e.VAT = a.VAT_doctor
+        LEFT JOIN consultation c ON a.date_timestamp = c.date_timestamp  AND a.VAT_doctor = c.VAT_doctor
+        WHERE a.VAT_client = %(vat)s
+          AND a.date_timestamp <= %(current_time)s
+          AND a.date_timestamp < COALESCE(%(before)s::timestamp, 'infinity')
+        ORDER BY a.date_timestamp DESC
+        LIMIT %(past_limit)s
+    );
+""")
+
+
+def parse_cursor(value):
+    """An ISO timestamp keyset cursor; malformed ones start from the first page."""
+    try:
+        return datetime.fromisoformat(value) if value else None
+    except ValueError:
+        return None
+
+
+def client_appointments_params(vat, args, page_size):
+    """Query parameters for one page of CLIENT_APPOINTMENTS_QUERY.
+
+    `scope` selects the upcoming or past slice only; `after`/`before` are the
+    keyset cursors of the upcoming and past slices.
+    """
+    scope = args.get("scope")
+    return {
+        "vat": vat,
+        "current_time": datetime.now(),
+        "after": parse_cursor(args.get("after")),
+        "before": parse_cursor(args.get("before")),
+        # One extra row tells whether there is a next page
+        "upcoming_limit": page_size + 1 if scope != "past" else 0,
+        "past_limit": page_size + 1 if scope != "upcoming" else 0,
+    }
 
-    return render_template("client_appointments.html", vat=vat, appointments=appointments)
 
+def paginate_client_appointments(rows, page_size):
+    """Split rows into (upcoming, past) plus the keyset cursors of their next pages."""
+    upcoming = [row for row in rows if row.slice == "upcoming"]
+    past = [row for row in rows if row.slice == "past"]
+    after = before = None
+    if len(upcoming) > page_size:
+        upcoming = upcoming[:page_size]
+        after = upcoming[-1].date_timestamp.isoformat()
+    if len(past) > page_size:
+        past = past[:page_size]
+        before = past[-1].date_timestamp.isoformat()
+    return upcoming, past, after, before
 
-@app.route("/consultation_details/<vat_doctor>/<string:consultation_date>")
-def consultation_details(vat_doctor, consultation_date):
-    with psycopg.connect(conninfo=DATABASE_URL) as conn:
-        with conn.cursor(row_factory=namedtuple_row) as cur:
-            soap_notes = cur.execute(
-                """
-                SELECT SOAP_S, SOAP_O, SOAP_A, SOAP_P
-                FROM consultation
-                WHERE VAT_doctor = %(vat_doctor)s AND date_timestamp = %(date_timestamp)s;
-                """,
-                {"vat_doctor": vat_doctor, "date_timestamp": consultation_date}
-            ).fetchall()
 
-    with psycopg.connect(conninfo=DATABASE_URL) as conn:
-        with conn.cursor(row_factory=namedtuple_row) as cur:
-            nurses = cur.execute(
-                """
-                SELECT e.name AS nurse_name
-                FROM consultation_assistant ca
-                JOIN employee e ON e.VAT = ca.VAT_nurse
-                WHERE ca.VAT_doctor = %(vat_doctor)s AND ca.date_timestamp = %(date_timestamp)s;
-                """,
-                {"vat_doctor": vat_doctor, "date_timestamp": consultation_date}
-            ).fetchall()
+@app.route("/client/<vat>/appointments", methods=["GET"])
+@read_only
+# Appointments move from upcoming to past as time goes by
+@conditional("appointments:{vat}", "consultations", time_bucket=60)
+def client_appointments(vat):
+    # Query the database to retrieve detailed information about appointments for the selected client
+    page_size = app.config.get("APPOINTMENTS_PAGE_SIZE", 20)
+    params = client_appointments_params(vat, request.args, page_size)
 
+    with db_cursor() as cur:
+        rows = queries.execute(cur, "client_appointments", params).fetchall()
 
-    with psycopg.connect(conninfo=DATABASE_URL) as conn:
-        with conn.cursor(row_factory=namedtuple_row) as cur:
-            diagnostic_codes = cur.execute(
-                """
-                SELECT d.ID, d.description
-                FROM consultation_diagnostic cd
-                JOIN diagnostic_code d ON cd.ID = d.ID
-                WHERE cd.VAT_doctor = %(vat_doctor)s AND cd.date_timestamp = %(date_timestamp)s;
-                """,
-                {"vat_doctor": vat_doctor, "date_timestamp": consultation_date}
-            ).fetchall()
+    upcoming, past, after, before = paginate_client_appointments(rows, page_size)
+    return render_template(
+        "client_appointments.html",
+        vat=vat,
+        appointments=upcoming + past,
+        upcoming=upcoming,
+        past=past,
+        next_upcoming=after and url_for("client_appointments", vat=vat, scope="upcoming", after=after),
+        next_past=before and url_for("client_appointments", vat=vat, scope="past", before=before),
+    )
 
-    with psycopg.connect(conninfo=DATABASE_URL) as conn:
-        with conn.cursor(row_factory=namedtuple_row) as cur:
-            prescriptions = cur.execute(
-                """
-                SELECT m.name, m.lab, cd.dosage, cd.description
-                FROM prescription cd
-                JOIN medication m ON cd.name = m.name AND cd.lab = m.lab
-                WHERE cd.VAT_doctor = %(vat_doctor)s AND cd.date_timestamp = %(date_timestamp)s;
-                """,
+
+CONSULTATION_DETAILS_QUERY = queries.register("consultation_details", """
+    SELECT
+        (SELECT COALESCE(json_agg(json_build_object(
+                    'soap_s', c.SOAP_S, 'soap_o', c.SOAP_O,
+                    'soap_a', c.SOAP_A, 'soap_p', c.SOAP_P)), '[]')
+         FROM consultation c
+         WHERE c.VAT_doctor = %(vat_doctor)s AND c.date_timestamp = %(date_timestamp)s
+        ) AS soap_notes,
+        (SELECT COALESCE(json_agg(json_build_object('nurse_name', e.name)), '[]')
+         FROM consultation_assistant ca
+         JOIN employee e ON e.VAT = ca.VAT_nurse
+         WHERE ca.VAT_doctor = %(vat_doctor)s AND ca.date_timestamp = %(date_timestamp)s
+        ) AS nurses,
+        (SELECT COALESCE(json_agg(json_build_object('id', d.ID, 'description', d.description)), '[]')
+         FROM consultation_diagnostic cd
+         JOIN diagnostic_code d ON cd.ID = d.ID
+         WHERE cd.VAT_doctor = %(vat_doctor)s AND cd.date_timestamp = %(date_timestamp)s
+        ) AS diagnostic_codes,
+        (SELECT COALESCE(json_agg(json_build_object(
+                    'name', m.name, 'lab', m.lab,
+                    'dosage', p.dosage, 'description', p.description)), '[]')
+         FROM prescription p
+         JOIN medication m ON p.name = m.name AND p.lab = m.lab
+         WHERE p.VAT_doctor = %(vat_doctor)s AND p.date_timestamp = %(date_timestamp)s
+        ) AS prescriptions;
+""")
+
+
+@app.route("/consultation_details/<vat_doctor>/<timestamp:consultation_date>")
+@read_only
+@conditional("consultation:{vat_doctor}:{consultation_date}")
+def consultation_details(vat_doctor, consultation_date):
+    details = consultation_cache.get((vat_doctor, consultation_date))
+    if details is not None:
+        served_by(pool)  # only primary reads are kept in the cache
+    else:
+        # SOAP notes, nurses, diagnostics and prescriptions in one round trip
+        with db_cursor() as cur:
+            details = queries.execute(
+                cur, "consultation_details",
                 {"vat_doctor": vat_doctor, "date_timestamp": consultation_date}
-            ).fetchall()
+            ).fetchone()._asdict()
+        if on_primary():
+            consultation_cache.set((vat_doctor, consultation_date), details)
 
     return render_template(
         "consultation_details.html",
         vat_doctor=vat_doctor,
         consultation_date=consultation_date,
-        soap_notes=soap_notes,
-        nurses=nurses,
-        diagnostic_codes=diagnostic_codes,
-        prescriptions=prescriptions,
+        **details,
     )
-    
-@app.route("/new_consultation_soap/<vat_doctor>/<string:consultation_date>", methods=["GET", "POST"])
+
+queries.register("insert_consultation", """
+    INSERT INTO consultation (VAT_doctor, date_timestamp, SOAP_S, SOAP_O, SOAP_A, SOAP_P)
+    VALUES (%s, %s, %s, %s, %s, %s);
+""")
+
+
+# Matches in either the consultation notes or the appointment description,
+# best ranked first; only the rows of the page get a highlighted snippet.
+queries.register("search_notes", """
+    WITH q AS (
+        SELECT websearch_to_tsquery('english', %(q)s) AS query
+    ),
+    hits AS (
+        SELECT c.VAT_doctor, c.date_timestamp
+        FROM consultation c, q
+        WHERE c.soap_tsv @@ q.query
+          AND c.date_timestamp >= %(since)s AND c.date_timestamp < %(until)s
+        UNION
+        SELECT a.VAT_doctor, a.date_timestamp
+        FROM appointment a, q
+        WHERE a.description_tsv @@ q.query
+          AND a.date_timestamp >= %(since)s AND a.date_timestamp < %(until)s
+    ),
+    ranked AS (
+        SELECT a.VAT_doctor, a.date_timestamp, a.VAT_client, a.description,
+               c.SOAP_S, c.SOAP_O, c.SOAP_A, c.SOAP_P,
+               ts_rank(coalesce(c.soap_tsv, ''::tsvector) || a.description_tsv, q.query) AS rank
+        FROM hits h
+        JOIN appointment a ON a.VAT_doctor = h.VAT_doctor AND a.date_timestamp = h.date_timestamp
+        LEFT JOIN consultation c ON c.VAT_doctor = h.VAT_doctor AND c.date_timestamp = h.date_timestamp
+        CROSS JOIN q
+    )
+    SELECT r.VAT_doctor, r.date_timestamp, r.VAT_client, r.rank,
+           ts_headline(
+               'english',
+               concat_ws(' ... ', r.description, r.SOAP_S, r.SOAP_O, r.SOAP_A, r.SOAP_P),
+               q.query,
+               'MaxFragments=3, MaxWords=20, MinWords=5, StartSel=<mark>, StopSel=</mark>'
+           ) AS headline
+    FROM ranked r, q
+    WHERE %(after_rank)s::real IS NULL
+       OR r.rank < %(after_rank)s::real
+       OR (r.rank = %(after_rank)s::real AND (r.VAT_doctor, r.date_timestamp) > (%(after_vat)s, %(after_date)s::timestamp))
+    ORDER BY r.rank DESC, r.VAT_doctor, r.date_timestamp
+    LIMIT %(limit)s;
+""")
+
+
+@app.route("/api/notes/search", methods=["GET"])
+@read_only
+def search_notes():
+    """Full-text search over SOAP notes and appointment descriptions.
+
+    `q` takes web-search syntax ("quoted phrases", or, -excluded); `since`
+    and `until` (YYYY-MM-DD) bound the consultation date, by default to the
+    last year. Results are keyset-paginated on (rank, VAT_doctor, date).
+    """
+    q = request.args.get("q", "").strip()
+    if not q:
+        return jsonify({"error": "q is required"}), 400
+    try:
+        until = request.args.get("until")
+        until = datetime.strptime(until, "%Y-%m-%d") + timedelta(days=1) if until else datetime.now()
+        since = request.args.get("since")
+        since = datetime.strptime(since, "%Y-%m-%d") if since else until - timedelta(days=365)
+    except ValueError:
+        return jsonify({"error": "since and until must be YYYY-MM-DD"}), 400
+    limit = max(1, min(request.args.get("limit", 20, type=int), 100))
+    after_rank = request.args.get("after_rank", type=float)
+    after_vat = after_date = None
+    if after_rank is not None:
+        after_vat = request.args.get("after_vat")
+        try:
+            after_date = datetime.fromisoformat(request.args.get("after_date", ""))
+        except ValueError:
+            return jsonify({"error": "after_rank needs after_vat and an ISO after_date"}), 400
+        if not after_vat:
+            return jsonify({"error": "after_rank needs after_vat and an ISO after_date"}), 400
+
+    with db_cursor() as cur:
+        rows = queries.execute(
+            cur, "search_notes",
+            {
+                "q": q,
+                "since": since,
+                "until": until,
+                "after_rank": after_rank,
+                "after_vat": after_vat,
+                "after_date": after_date,
+                "limit": limit,
+            }
+        ).fetchall()
+
+    next_page = None
+    if len(rows) == limit:
+        next_page = url_for(
+            "search_notes",
+            **{
+                **request.args.to_dict(),
+                "after_rank": rows[-1].rank,
+                "after_vat": rows[-1].vat_doctor,
+                "after_date": rows[-1].date_timestamp.isoformat(),
+            },
+        )
+    return jsonify(
+        {
+            "results": [
+                {
+                    **row._asdict(),
+                    "date_timestamp": row.date_timestamp.isoformat(),
+                    "url": url_for(
+                        "consultation_details", vat_doctor=row.vat_doctor, consultation_date=row.date_timestamp
+                    ),
+                }
+                for row in rows
+            ],
+            "next": next_page,
+        }
+    )
+
+
+@app.route("/new_consultation_soap/<vat_doctor>/<timestamp:consultation_date>", methods=["GET", "POST"])
 def new_consultation_soap(vat_doctor, consultation_date):
     if request.method == "POST":
         # Handle SOAP notes insertion here
@@ -342,132 +1907,183 @@ def new_consultation_soap(vat_doctor, consultation_date):
         soap_a = request.form.get('soap_a')
         soap_p = request.form.get('soap_p')
 
-        with psycopg.connect(conninfo=DATABASE_URL) as conn:
-            with conn.cursor(row_factory=namedtuple_row) as cur:
-                cur.execute(
-                    """
-                    INSERT INTO consultation (VAT_doctor, date_timestamp, SOAP_S, SOAP_O, SOAP_A, SOAP_P)
-                    VALUES (%s, %s, %s, %s, %s, %s);
-                    """,
-                    (vat_doctor, consultation_date, soap_s, soap_o, soap_a, soap_p)
-                )
-                conn.commit()
+        with db_cursor() as cur:
+            queries.execute(
+                cur, "insert_consultation",
+                (vat_doctor, consultation_date, soap_s, soap_o, soap_a, soap_p)
+            )
+        consultation_changed(vat_doctor, consultation_date)
         return redirect(url_for('new_consultation_nurse', vat_doctor = vat_doctor, consultation_date = consultation_date))
                 
     return render_template("new_consultation_soap.html", vat_doctor = vat_doctor, consultation_date = consultation_date)
 
-@app.route("/new_consultation_nurse/<vat_doctor>/<string:consultation_date>", methods=["GET", "POST"])
+queries.register("available_nurses", """
+    SELECT n.VAT, e.name
+    FROM nurse n 
+    JOIN employee e ON e.VAT = n.VAT
+    WHERE n.VAT NOT IN (
+        SELECT VAT_nurse
+        FROM consultation_assistant
+        WHERE VAT_doctor = %(vat_doctor)s AND date_timestamp = %(consultation_date)s
+    );
+""")
+
+
+queries.register("assign_nurses", """
+    WITH requested AS (
+        SELECT DISTINCT unnest(%(vat_nurses)s::text[]) AS VAT
+    ),
+    assigned AS (
+        INSERT INTO consultation_assistant (VAT_doctor, date_timestamp, VAT_nurse)
+        SELECT %(vat_doctor)s, %(consultation_date)s, n.VAT
+        FROM nurse n
+        JOIN requested r ON r.VAT = n.VAT
+        ON CONFLICT DO NOTHING
+        RETURNING VAT_nurse
+    )
+    SELECT r.VAT,
+           CASE
+               WHEN a.VAT_nurse IS NOT NULL THEN 'assigned'
+               WHEN n.VAT IS NULL THEN 'invalid'
+               ELSE 'already_assigned'
+           END AS status
+    FROM requested r
+    LEFT JOIN nurse n ON n.VAT = r.VAT
+    LEFT JOIN assigned a ON a.VAT_nurse = r.VAT
+    ORDER BY r.VAT;
+""")
+
+
+def assign_nurses(vat_doctor, consultation_date, vat_nurses):
+    """Assign many nurses to a consultation in one statement.
+
+    Returns {"assigned": [...], "already_assigned": [...], "invalid": [...]}
+    where invalid VATs are those that do not belong to a nurse.
+    """
+    result = {"assigned": [], "already_assigned": [], "invalid": []}
+    vat_nurses = [vat.strip() for vat in vat_nurses if vat and vat.strip()]
+    if not vat_nurses:
+        return result
+    with db_cursor() as cur:
+        rows = queries.execute(
+            cur, "assign_nurses",
+            {"vat_doctor": vat_doctor, "consultation_date": consultation_date, "vat_nurses": vat_nurses}
+        ).fetchall()
+    for row in rows:
+        result[row.status].append(row.vat)
+    if result["assigned"]:
+        consultation_changed(vat_doctor, consultation_date)
+    return result
+
+
+@app.route("/new_consultation_nurse/<vat_doctor>/<timestamp:consultation_date>", methods=["GET", "POST"])
 def new_consultation_nurse(vat_doctor, consultation_date):
-    # Fetch all nurses from the database
-    with psycopg.connect(conninfo=DATABASE_URL) as conn:
-        with conn.cursor(row_factory=namedtuple_row) as cur:
-            cur.execute(
-                """
-                SELECT n.VAT, e.name
-                FROM nurse n 
-                JOIN employee e ON e.VAT = n.VAT
-                WHERE n.VAT NOT IN (
-                    SELECT VAT_nurse
-                    FROM consultation_assistant
-                    WHERE VAT_doctor = %(vat_doctor)s AND date_timestamp = %(consultation_date)s
-                );
-                """,
-                {"vat_doctor": vat_doctor, "consultation_date": consultation_date}
-            )
-            nurses = cur.fetchall()
-
     if request.method == "POST":
-        vat_nurse = request.form.get('input_nurse_vat')
+        # Nurses picked from the list plus any VATs typed in, comma separated
+        vat_nurses = request.form.getlist("nurse_vat") + request.form.get("input_nurse_vat", "").split(",")
+        try:
+            result = assign_nurses(vat_doctor, consultation_date, vat_nurses)
+        except ForeignKeyViolation:
+            flash("That consultation does not exist.")
+        else:
+            if result["assigned"]:
+                flash(f"Nurses with VAT {', '.join(result['assigned'])} successfully registered as assisting in the consultation!")
+            if result["already_assigned"]:
+                flash(f"Already registered as assisting that consultation: {', '.join(result['already_assigned'])}")
+            if result["invalid"]:
+                flash(f"The following VATs do not correspond to a nurse: {', '.join(result['invalid'])}")
+            if not any(result.values()):
+                flash("No nurse VAT inserted.")
+
+    # Nurses not yet assisting, read after any assignment above
+    with db_cursor() as cur:
+        nurses = queries.execute(
+            cur, "available_nurses",
+            {"vat_doctor": vat_doctor, "consultation_date": consultation_date}
+        ).fetchall()
 
-        with psycopg.connect(conninfo=DATABASE_URL) as conn:
-            with conn.cursor() as cur:
-                cur.execute(
-                    """
-                    SELECT *
-                    FROM consultation_assistant
-                    WHERE VAT_doctor = %(vat_doctor)s AND VAT_nurse = %(vat_nurse)s AND date_timestamp = %(consultation_date)s
-                    """,
-                    {"vat_doctor": vat_doctor, "vat_nurse": vat_nurse, "consultation_date": consultation_date}
-                )
-                already_assist = cur.fetchone()
-
-                if already_assist:
-                    flash("That nurse is already registered as assisting that consultation")
-                elif vat_nurse in [n.vat for n in nurses]:
-                    cur.execute(
-                        """
-                        INSERT INTO consultation_assistant (VAT_doctor, date_timestamp, VAT_nurse)
-                        VALUES (%s, %s, %s);
-                        """,
-                        (vat_doctor, consultation_date, vat_nurse)
-                    )
-                    conn.commit()
+    return render_template("new_consultation_nurse.html", vat_doctor=vat_doctor, consultation_date=consultation_date, nurses=nurses)
 
-                    flash(f"Nurse with VAT {vat_nurse} successfully registered as assisting in the consultation!")
-                else:
-                    flash("The following VAT does not correspond to a nurse.")
 
-    return render_template("new_consultation_nurse.html", vat_doctor=vat_doctor, consultation_date=consultation_date, nurses=nurses)
+@app.route("/api/consultation_nurses/<vat_doctor>/<timestamp:consultation_date>", methods=["POST"])
+def assign_nurses_api(vat_doctor, consultation_date):
+    """Assign a team of nurses, given as JSON {"nurses": ["<vat>", ...]}."""
+    vat_nurses = (request.get_json(silent=True) or {}).get("nurses")
+    if not isinstance(vat_nurses, list) or not all(isinstance(vat, str) for vat in vat_nurses):
+        return jsonify({"error": "nurses must be a list of VATs"}), 400
+    try:
+        result = assign_nurses(vat_doctor, consultation_date, vat_nurses)
+    except ForeignKeyViolation as e:
+        return jsonify({"error": "consultation does not exist", "detail": str(e)}), 404
+    return jsonify({"vat_doctor": vat_doctor, "consultation_date": consultation_date.isoformat(), **result})
+
+# An existing code is read, not rewritten; the SELECT runs on the statement's
+# snapshot, so a code inserted concurrently after it yields no row.
+queries.register("link_new_diagnostic", """
+    WITH new AS (
+        INSERT INTO diagnostic_code (description)
+        VALUES (%(diagnostic_desc)s)
+        ON CONFLICT (description) DO NOTHING
+        RETURNING ID
+    ),
+    code AS (
+        SELECT ID, true AS inserted FROM new
+        UNION ALL
+        SELECT ID, false FROM diagnostic_code WHERE description = %(diagnostic_desc)s
+    ),
+    link AS (
+        INSERT INTO consultation_diagnostic (VAT_doctor, date_timestamp, ID)
+        SELECT %(vat_doctor)s, %(consultation_date)s, ID
+        FROM code
+    )
+    SELECT ID, inserted FROM code;
+""")
 
-@app.route("/new_consultation_diagnostic/<vat_doctor>/<string:consultation_date>", methods=["GET", "POST"])
-def new_consultation_diagnostic(vat_doctor, consultation_date):
 
-    with psycopg.connect(conninfo=DATABASE_URL) as conn:
-        with conn.cursor(row_factory=namedtuple_row) as cur:
-            cur.execute(
-                """
-                SELECT description
-                FROM diagnostic_code
-                """
-            )
-            diagnostic_list = cur.fetchall()
+queries.register("link_diagnostic", """
+    INSERT INTO consultation_diagnostic (VAT_doctor, date_timestamp, ID)
+    VALUES (%s, %s, %s);
+""")
+
+
+@app.route("/new_consultation_diagnostic/<vat_doctor>/<timestamp:consultation_date>", methods=["GET", "POST"])
+def new_consultation_diagnostic(vat_doctor, consultation_date):
+    diagnostic_list, diagnostic_ids = reference_data.diagnostic_codes()
 
     if request.method == "POST":
         diagnostic_desc = request.form.get('input_diagnostic')
 
-        with psycopg.connect(conninfo=DATABASE_URL) as conn:
-            with conn.cursor(row_factory=namedtuple_row) as cur:
-                cur.execute(
-                    """
-                    SELECT ID, description
-                    FROM diagnostic_code 
-                    WHERE description = %(diagnostic_desc)s
-                    """,
-                    {"diagnostic_desc": diagnostic_desc}
-                )
-                diagnostic = cur.fetchone()
-
-        if  not diagnostic:
-            with psycopg.connect(conninfo=DATABASE_URL) as conn:
-                with conn.cursor(row_factory=namedtuple_row) as cur:
-                    cur.execute("SELECT MAX(ID) FROM diagnostic_code;")
-                    max_id = cur.fetchone().max
-                    new_id = max_id + 1
-
-                    cur.execute(
-                        """
-                        INSERT INTO diagnostic_code (ID, description)
-                        VALUES (%s, %s);
-                        """,
-                        (new_id, diagnostic_desc)
-                    )
-                    conn.commit()
-            diagnostic_id = new_id
-        
-        else:
-            diagnostic_id = diagnostic.id
-
         try:
-            with psycopg.connect(conninfo=DATABASE_URL) as conn:
-                with conn.cursor(row_factory=namedtuple_row) as cur:
-                    cur.execute(
-                        """
-                        INSERT INTO consultation_diagnostic (VAT_doctor, date_timestamp, ID)
-                        VALUES (%s, %s, %s);
-                        """,
-                        (vat_doctor, consultation_date,diagnostic_id)
+            with db_cursor() as cur:
+                diagnostic_id = diagnostic_ids.get(diagnostic_desc)
+                if diagnostic_id is not None:
+                    queries.execute(
+                        cur, "link_diagnostic",
+                        (vat_doctor, consultation_date, diagnostic_id)
                     )
-                    conn.commit()
+                else:
+                    # Resolve or create the code and link it in one statement;
+                    # IDs come from diagnostic_code_id_seq, so concurrent
+                    # inserts cannot collide.
+                    code = queries.execute(
+                        cur, "link_new_diagnostic",
+                        {
+                            "diagnostic_desc": diagnostic_desc,
+                            "vat_doctor": vat_doctor,
+                            "consultation_date": consultation_date,
+                        }
+                    ).fetchone()
+                    if code is None:
+                        # Inserted by a concurrent transaction after our snapshot
+                        diagnostic_id = cur.execute(
+                            "SELECT ID FROM diagnostic_code WHERE description = %s;", (diagnostic_desc,)
+                        ).fetchone().id
+                        queries.execute(cur, "link_diagnostic", (vat_doctor, consultation_date, diagnostic_id))
+                    else:
+                        diagnostic_id = code.id
+                        if code.inserted:
+                            notify_reference_change(cur, "diagnostic_code")
+            consultation_changed(vat_doctor, consultation_date)
             return redirect(url_for('new_consultation_prescription', diagnostic_id=diagnostic_id, vat_doctor=vat_doctor, consultation_date=consultation_date))
         except UniqueViolation:
             flash("The insert diagnostic, has already been inserted.")
@@ -478,18 +2094,22 @@ def new_consultation_diagnostic(vat_doctor, consultation_date):
     return render_template("new_consultation_diagnostic.html", vat_doctor=vat_doctor, consultation_date=consultation_date, diagnostic_list= diagnostic_list)
 
 
-@app.route("/new_consultation_prescription/<int:diagnostic_id>/<vat_doctor>/<string:consultation_date>", methods=["GET", "POST"])
+queries.register("insert_medication", """
+    INSERT INTO medication (name, lab)
+    VALUES (%s, %s)
+    ON CONFLICT DO NOTHING;
+""")
+
+
+queries.register("insert_prescription", """
+    INSERT INTO prescription (VAT_doctor, date_timestamp, ID, name, lab, dosage, description)
+    VALUES (%s, %s, %s, %s, %s, %s, %s);
+""")
+
+
+@app.route("/new_consultation_prescription/<int:diagnostic_id>/<vat_doctor>/<timestamp:consultation_date>", methods=["GET", "POST"])
 def new_consultation_prescription(diagnostic_id, vat_doctor, consultation_date):
-    # Fetch med lab pairs from the database
-    with psycopg.connect(conninfo=DATABASE_URL) as conn:
-        with conn.cursor(row_factory=namedtuple_row) as cur:
-            cur.execute(
-                """
-                SELECT name, lab
-                FROM medication
-                """
-            )
-            med_lab_list = cur.fetchall()
+    med_lab_list, med_labs = reference_data.medications()
 
     if request.method == "POST":
         name = request.form.get('med_name')
@@ -497,29 +2117,22 @@ def new_consultation_prescription(diagnostic_id, vat_doctor, consultation_date):
         dosage = request.form.get('dosage')
         description = request.form.get('prescription_desc')
 
-        if (name, lab) not in med_lab_list:
-            with psycopg.connect(conninfo=DATABASE_URL) as conn:
-                with conn.cursor() as cur:
-                    cur.execute(
-                        """
-                        INSERT INTO medication (name, lab)
-                        VALUES (%s, %s);
-                        """,
-                        (name, lab)
-                    )
-                    conn.commit()
+        if (name, lab) not in med_labs:
+            with db_cursor() as cur:
+                inserted = queries.execute(
+                    cur, "insert_medication",
+                    (name, lab)
+                ).rowcount
+                if inserted:
+                    notify_reference_change(cur, "medication")
 
         try:
-            with psycopg.connect(conninfo=DATABASE_URL) as conn:
-                with conn.cursor() as cur:
-                    cur.execute(
-                        """
-                        INSERT INTO prescription (VAT_doctor, date_timestamp, ID, name, lab, dosage, description)
-                        VALUES (%s, %s, %s, %s, %s, %s, %s);
-                        """,
-                        (vat_doctor, consultation_date, diagnostic_id, name, lab, dosage, description)
-                    )
-                    conn.commit()
+            with db_cursor() as cur:
+                queries.execute(
+                    cur, "insert_prescription",
+                    (vat_doctor, consultation_date, diagnostic_id, name, lab, dosage, description)
+                )
+            consultation_changed(vat_doctor, consultation_date)
         except UniqueViolation:
             flash("The medication inserted, has already been prescribed for this consultation diagnostic")
             
@@ -528,114 +2141,935 @@ def new_consultation_prescription(diagnostic_id, vat_doctor, consultation_date):
             
     return render_template("new_consultation_prescription.html", diagnostic_id=diagnostic_id, vat_doctor=vat_doctor, consultation_date=consultation_date, med_lab_list=med_lab_list)
 
+@app.route("/api/consultation_draft/<vat_doctor>/<timestamp:consultation_date>", methods=["POST"])
+def submit_consultation(vat_doctor, consultation_date):
+    """Write a whole consultation in one transaction.
+
+    Expects JSON of the form
+        {"soap": {"s": ..., "o": ..., "a": ..., "p": ...},
+         "nurses": ["<vat>", ...],
+         "diagnostics": [{"description": ...,
+                          "prescriptions": [{"name", "lab", "dosage", "description"}, ...]}, ...]}
+    Child rows are sent with executemany, which psycopg pipelines into a
+    single round trip, and the whole consultation costs one commit.
+    """
+    draft = request.get_json(silent=True) or {}
+    soap = draft.get("soap") or {}
+    nurses = draft.get("nurses") or []
+    diagnostics = draft.get("diagnostics") or []
+    if not isinstance(soap, dict) or not isinstance(nurses, list) or not isinstance(diagnostics, list):
+        return jsonify({"error": "soap must be an object, nurses and diagnostics lists"}), 400
+    if not all(isinstance(vat_nurse, str) for vat_nurse in nurses):
+        return jsonify({"error": "nurses must be a list of VATs"}), 400
+    try:
+        descriptions = sorted({d["description"] for d in diagnostics})
+        prescriptions = [
+            (d["description"], p["name"], p["lab"], p.get("dosage"), p.get("description"))
+            for d in diagnostics
+            for p in d.get("prescriptions") or []
+        ]
+    except (KeyError, TypeError):
+        return jsonify({"error": "diagnostics need a description, prescriptions a name and lab"}), 400
+    names = [value for _, name, lab, _, _ in prescriptions for value in (name, lab)]
+    if not all(isinstance(value, str) and value.strip() for value in [*descriptions, *names]):
+        return jsonify({"error": "descriptions, names and labs must be non-empty strings"}), 400
+    notes = [soap.get(part) for part in "soap"]
+    notes += [value for _, _, _, dosage, description in prescriptions for value in (dosage, description)]
+    if not all(value is None or isinstance(value, str) for value in notes):
+        return jsonify({"error": "SOAP notes, dosages and prescription descriptions must be strings"}), 400
+
+    try:
+        with db_cursor() as cur:
+            cur.execute(
+                """
+                INSERT INTO consultation (VAT_doctor, date_timestamp, SOAP_S, SOAP_O, SOAP_A, SOAP_P)
+                VALUES (%s, %s, %s, %s, %s, %s);
+                """,
+                (vat_doctor, consultation_date, soap.get("s"), soap.get("o"), soap.get("a"), soap.get("p"))
+            )
+            cur.executemany(
+                """
+                INSERT INTO consultation_assistant (VAT_doctor, date_timestamp, VAT_nurse)
+                VALUES (%s, %s, %s);
+                """,
+                [(vat_doctor, consultation_date, vat_nurse) for vat_nurse in dict.fromkeys(nurses)]
+            )
+
+            diagnostic_ids = {}
+            if descriptions:
+                # Existing codes are read, not rewritten; the SELECT runs on
+                # the statement's snapshot, so it never sees the new rows
+                codes = cur.execute(
+                    """
+                    WITH new AS (
+                        INSERT INTO diagnostic_code (description)
+                        SELECT unnest(%(descriptions)s::text[])
+                        ON CONFLICT (description) DO NOTHING
+                        RETURNING ID, description
+                    )
+                    SELECT ID, description, true AS inserted FROM new
+                    UNION ALL
+                    SELECT ID, description, false FROM diagnostic_code WHERE description = ANY(%(descriptions)s::text[]);
+                    """,
+                    {"descriptions": descriptions}
+                ).fetchall()
+                diagnostic_ids = {code.description: code.id for code in codes}
+                missing = [description for description in descriptions if description not in diagnostic_ids]
+                if missing:
+                    # Inserted by a concurrent transaction after our snapshot
+                    codes += cur.execute(
+                        "SELECT ID, description, false AS inserted FROM diagnostic_code WHERE description = ANY(%s::text[]);",
+                        (missing,)
+                    ).fetchall()
+                    diagnostic_ids = {code.description: code.id for code in codes}
+                cur.executemany(
+                    """
+                    INSERT INTO consultation_diagnostic (VAT_doctor, date_timestamp, ID)
+                    VALUES (%s, %s, %s);
+                    """,
+                    [(vat_doctor, consultation_date, code_id) for code_id in diagnostic_ids.values()]
+                )
+                if any(code.inserted for code in codes):
+                    notify_reference_change(cur, "diagnostic_code")
+
+            if prescriptions:
+                med_labs = sorted({(name, lab) for _, name, lab, _, _ in prescriptions})
+                cur.execute(
+                    """
+                    INSERT INTO medication (name, lab)
+                    SELECT * FROM unnest(%s::text[], %s::text[])
+                    ON CONFLICT DO NOTHING;
+                    """,
+                    ([name for name, _ in med_labs], [lab for _, lab in med_labs])
+                )
+                new_medications = cur.rowcount
+                cur.executemany(
+                    """
+                    INSERT INTO prescription (VAT_doctor, date_timestamp, ID, name, lab, dosage, description)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s);
+                    """,
+                    [
+                        (vat_doctor, consultation_date, diagnostic_ids[desc], name, lab, dosage, description)
+                        for desc, name, lab, dosage, description in prescriptions
+                    ]
+                )
+                if new_medications:
+                    notify_reference_change(cur, "medication")
+    except UniqueViolation as e:
+        return jsonify({"error": "consultation or one of its rows already exists", "detail": str(e)}), 409
+    except (ForeignKeyViolation, DataError) as e:
+        return jsonify({"error": "invalid reference in consultation", "detail": str(e)}), 400
+
+    consultation_changed(vat_doctor, consultation_date)
+    return jsonify(
+        {
+            "vat_doctor": vat_doctor,
+            "consultation_date": consultation_date.isoformat(),
+            "nurses": len(set(nurses)),
+            "diagnostics": diagnostic_ids,
+            "prescriptions": len(prescriptions),
+        }
+    ), 201
+
+
 @app.route("/dashboard", methods=["GET", "POST"])
+@read_only
+@conditional("facts")
 def consultations_data():
-    if request.method == "GET":
-         try:
-             with psycopg.connect(conninfo=DATABASE_URL) as conn:
-                with conn.cursor(row_factory=namedtuple_row) as cur:
-                    consultations_data = cur.execute(
-                        """
-                        SELECT *
-                        FROM facts_consultations 
-                        """
-                    ).fetchall()
-         except psycopg2.Error as e:
-             print(f"Database error: {e}")
+    if request.method == "POST":
+        try:
+            start_date, end_date = parse_date_range(request.form.get("start_date"), request.form.get("end_date"))
+        except ValueError:
+            flash("Invalid date interval.")
+        else:
+            # Rows are rendered as they are fetched so memory stays flat
+            return stream_template(
+                "dashboard.html",
+                total_consultations=get_total_consultations(),
+                consults_by_year=get_consults_by_year(),
+                consults_by_interval=get_consultations_between_dates(start_date, end_date),
+            )
+
+    # One keyset page of the facts table, with a link to the next one
+    try:
+        after_date, after_vat, limit = consultations_page_args(request.args, app.config.get("DASHBOARD_PAGE_SIZE", 50))
+    except ValueError:
+        after_date, after_vat, limit = None, None, app.config.get("DASHBOARD_PAGE_SIZE", 50)
+    rows, cursor = consultations_page(after_date, after_vat, limit)
+    return render_template(
+        "dashboard.html",
+        total_consultations=get_total_consultations(),
+        consults_by_year=get_consults_by_year(),
+        consultations_data=rows,
+        next_page=cursor and url_for("consultations_data", limit=limit, **cursor),
+    )
+
+
+queries.register("consultations_page_after", """
+    SELECT VAT, date, zip, num_diagnostic_codes, num_procedures
+    FROM facts_consultations
+    WHERE (date, VAT) > (%(after_date)s, %(after_vat)s)
+    ORDER BY date, VAT
+    LIMIT %(limit)s;
+""")
+
+
+queries.register("consultations_first_page", """
+    SELECT VAT, date, zip, num_diagnostic_codes, num_procedures
+    FROM facts_consultations
+    ORDER BY date, VAT
+    LIMIT %(limit)s;
+""")
+
+
+def consultations_page_args(args, default_limit):
+    """(after_date, after_vat, limit) from query args, ValueError if malformed."""
+    limit = max(1, min(args.get("limit", default_limit, type=int), 5000))
+    after_date = args.get("after_date") or None
+    after_vat = args.get("after_vat") or None
+    if after_date:
+        datetime.fromisoformat(after_date)
+    return after_date, after_vat, limit
+
+
+def consultations_page(after_date, after_vat, limit):
+    """One page of facts_consultations in (date, VAT) order, plus the next page's cursor."""
+    with db_cursor() as cur:
+        if after_date and after_vat:
+            rows = queries.execute(
+                cur, "consultations_page_after",
+                {"after_date": after_date, "after_vat": after_vat, "limit": limit + 1},
+            ).fetchall()
+        else:
+            rows = queries.execute(
+                cur, "consultations_first_page",
+                {"limit": limit + 1},
+            ).fetchall()
+
+    # The extra row only tells whether there is a next page
+    cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        cursor = {"after_date": rows[-1].date.isoformat(), "after_vat": rows[-1].vat}
+    return rows, cursor
+
+
+@app.route("/api/consultations", methods=["GET"])
+@read_only
+def consultations_api():
+    """One page of facts_consultations, keyset-paginated on (date, VAT)."""
+    try:
+        after_date, after_vat, limit = consultations_page_args(request.args, 500)
+    except ValueError:
+        return jsonify({"error": "after_date must be an ISO date"}), 400
+    rows, cursor = consultations_page(after_date, after_vat, limit)
+    return jsonify(
+        {
+            "consultations": [
+                {**row._asdict(), "date": row.date.isoformat()} for row in rows
+            ],
+            "next": cursor and url_for("consultations_api", limit=limit, **cursor),
+        }
+    )
+
+def parse_date_range(start_date_str, end_date_str):
+    """Parse a YYYY-MM-DD range, raising ValueError on bad or inverted input."""
+    start_date = datetime.strptime(start_date_str or "", "%Y-%m-%d").date()
+    end_date = datetime.strptime(end_date_str or "", "%Y-%m-%d").date()
+    if end_date < start_date:
+        raise ValueError("end date before start date")
+    return start_date, end_date
 
-    return render_template('dashboard.html', consultations_data=consultations_data)
 
 def get_consultations_between_dates(start_date, end_date):
+    """Yield the facts of a date range; the BRIN index on date limits the scan."""
+    with db_cursor(name="facts_consultations_range") as cur:
+        cur.itersize = app.config.get("STREAM_BATCH_SIZE", 2000)
+        cur.execute(
+            """
+            SELECT VAT, date, zip, num_diagnostic_codes, num_procedures
+            FROM facts_consultations
+            WHERE date BETWEEN %s AND %s
+            ORDER BY date, VAT
+            """,
+            (start_date, end_date)
+        )
+        yield from cur
+
+
+@app.route("/api/consultations/range", methods=["GET"])
+@read_only
+def export_consultations_between_dates():
+    """Stream a date range of facts_consultations as CSV or JSON."""
+    try:
+        start_date, end_date = parse_date_range(request.args.get("start"), request.args.get("end"))
+    except ValueError:
+        return jsonify({"error": "start and end must be YYYY-MM-DD dates, start <= end"}), 400
+    rows = get_consultations_between_dates(start_date, end_date)
+
+    if request.args.get("format", "json") == "csv":
+        def generate_csv():
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerow(("vat", "date", "zip", "num_diagnostic_codes", "num_procedures"))
+            for row in rows:
+                writer.writerow(row)
+                if buffer.tell() > 65536:
+                    yield buffer.getvalue()
+                    buffer.seek(0)
+                    buffer.truncate()
+            yield buffer.getvalue()
+
+        filename = f"consultations_{start_date}_{end_date}.csv"
+        return Response(
+            stream_with_context(generate_csv()),
+            mimetype="text/csv",
+            headers={"Content-Disposition": f"attachment; filename={filename}"},
+        )
+
+    def generate_json():
+        yield "["
+        for i, row in enumerate(rows):
+            yield ("," if i else "") + json.dumps(row._asdict(), default=str)
+        yield "]"
+
+    return Response(stream_with_context(generate_json()), mimetype="application/json")
+
+
+dashboard_stats_cache = LRUCache(maxsize=8, ttl=app.config.get("DASHBOARD_CACHE_TTL", 60))
+dashboard_refresh_lock = threading.Lock()
+
+
+def refresh_dashboard_aggregates():
+    """Refresh the dashboard materialized views without blocking readers.
+
+    The views only read facts_consultations, so this runs when facts change:
+    after the facts ETL loads rows, from a dashboard_refresh job or from
+    POST /dashboard/refresh. Every worker then drops its cached aggregates.
+    """
+    if not dashboard_refresh_lock.acquire(blocking=False):
+        return False  # another thread is already refreshing
+    try:
+        ensure_pools_open()
+        with pool.connection() as conn:
+            conn.execute("REFRESH MATERIALIZED VIEW CONCURRENTLY mv_consults_by_year;")
+            conn.execute("REFRESH MATERIALIZED VIEW CONCURRENTLY mv_consults_by_client;")
+        log.info("Refreshed dashboard aggregates.")
+    finally:
+        dashboard_refresh_lock.release()
+    announce_facts()
+    return True
+
+
+def dashboard_stat(name, query):
+    """Read an aggregate from its materialized view, cached for DASHBOARD_CACHE_TTL."""
+    rows = dashboard_stats_cache.get(name)
+    if rows is not None:
+        served_by(pool)  # only primary reads are kept in the cache
+    else:
+        with db_cursor() as cur:
+            rows = cur.execute(query).fetchall()
+        if on_primary():
+            dashboard_stats_cache.set(name, rows)
+    return rows
+
+
+def get_total_consultations():
+    return dashboard_stat(
+        "total",
+        """
+        SELECT COALESCE(SUM(total_consultations), 0) AS total_consultations
+        FROM mv_consults_by_year
+        """,
+    )
 
-    start_date_str = request.form['start_date']
-    end_date_str = request.form['end_date']
 
-    start_date = datetime.strptime(start_date_str, "%Y-%m-%d")
-    end_date = datetime.strptime(end_date_str, "%Y-%m-%d")
+def get_consults_by_client():
+    return dashboard_stat(
+        "by_client",
+        """
+        SELECT VAT, total_consultations
+        FROM mv_consults_by_client
+        ORDER BY VAT
+        """,
+    )
 
-    if request.method=="POST":
-        try:
-        
-            with psycopg.connect(conninfo=DATABASE_URL) as conn:
-                with conn.cursor(row_factory=namedtuple_row) as cur:
-                     consults_by_interval = cur.execute(
-                         """
-                        SELECT *
-                        FROM facts_consultations
-                        WHERE date BETWEEN %s AND %s
-                        """,
-                        (start_date, end_date)
-                     ).fetchall()
-                 
-            
 
-        except psycopg2.Error as e:
-            print(f"Database error: {e}")
-        finally:
-            if conn:
-                conn.close()
-    return render_template('dashboard.html', consults_by_interval=consults_by_interval)
+def get_consults_by_year():
+    return dashboard_stat(
+        "by_year",
+        """
+        SELECT year, total_consultations
+        FROM mv_consults_by_year
+        ORDER BY year
+        """,
+    )
 
-   
 
+@app.route("/dashboard/total", methods=["GET"])
+@read_only
 def total_consultations():
-    if request.method == "GET":
-        try:
-            with psycopg.connect(conninfo=DATABASE_URL) as conn:
-                with con.cursor(row_factory=namedtuple_row)as cur:
-                    total_consultations=cur.execute(
-                        """ 
-                        SELECT COUNT(*) as total_consultations 
-                        FROM facts_consultations
-                        """
-                     ).fetchall()
-            
-        except psycopg2.Error as e:
-            print(f"Database error: {e}")
-                
-    return render_template('dashboard.html', total_consultations=total_consultations)
+    return render_template('dashboard.html', total_consultations=get_total_consultations())
 
+@app.route("/dashboard/by_client", methods=["GET"])
+@read_only
 def consults_by_client():
-    if request.method == "GET":
-        try:
-            with psycopg2.connect(conninfo=DATABASE_URL) as conn:
-                with connection.cursor(row_factory=namedtuple_row) as cur:
-                    consults_by_client = cur.execute(
-                        """
-                            SELECT VAT,count(*) as total_consultations
-                            FROM facts_consultations
-                            GROUP BY VAT
-                        """
-                    ).fetchall()
+    return render_template('dashboard.html', consults_by_client=get_consults_by_client())
+
+@app.route("/dashboard/by_year", methods=["GET"])
+@read_only
+def consults_by_year():
+    return render_template('dashboard.html', consults_by_year=get_consults_by_year())
 
-        except psycopg2.Error as e:
-            print(f"Database error: {e}")
+@app.route("/dashboard/refresh", methods=["POST"])
+def refresh_dashboard():
+    refreshed = refresh_dashboard_aggregates()
+    return jsonify({"refreshed": refreshed})
 
-        
 
-        return render_template('dashboard.html', consults_by_client=consults_by_client)
+# Dashboard drill-downs
+#
+# facts_consultations (or a date slice of it) is loaded once into NumPy
+# columns and kept until the "facts" version changes, i.e. until the ETL or a
+# refresh announces new facts. Every breakdown is then a vectorized pass over
+# those arrays instead of another GROUP BY round trip. VAT and zip are stored
+# as integer codes into their sorted unique labels.
+facts_columns_cache = LRUCache(maxsize=4, ttl=app.config.get("ANALYTICS_CACHE_TTL", 3600))
 
-def consults_by_year():
-    if request.method == "GET":
+
+def load_facts_columns(start_date=None, end_date=None):
+    import numpy as np  # only the analytics endpoints need NumPy
+
+    key = (response_cache.version("facts"), start_date, end_date)
+    columns = facts_columns_cache.get(key)
+    if columns is None:
+        started = time.perf_counter()
+        with db_cursor(row_factory=tuple_row, name="facts_columns") as cur:
+            cur.itersize = app.config.get("STREAM_BATCH_SIZE", 2000)
+            cur.execute(
+                """
+                SELECT VAT, date::date - DATE '1970-01-01', zip, num_diagnostic_codes, num_procedures
+                FROM facts_consultations
+                WHERE date BETWEEN COALESCE(%s, '-infinity'::date) AND COALESCE(%s, 'infinity'::date)
+                """,
+                (start_date, end_date)
+            )
+            rows = cur.fetchall()
+        vats, days, zips, diagnostics, procedures = zip(*rows) if rows else ((),) * 5
+        vat_labels, vat_codes = np.unique(np.array(vats, dtype=str), return_inverse=True)
+        zip_labels, zip_codes = np.unique(np.array(zips, dtype=str), return_inverse=True)
+        columns = {
+            "vat_labels": vat_labels,
+            "vat": vat_codes,
+            "zip_labels": zip_labels,
+            "zip": zip_codes,
+            "date": np.array(days, dtype="datetime64[D]"),
+            "num_diagnostic_codes": np.array(diagnostics, dtype=np.int64),
+            "num_procedures": np.array(procedures, dtype=np.int64),
+        }
+        if on_primary():
+            facts_columns_cache.set(key, columns)
+        metrics.observe("analytics_load_seconds", time.perf_counter() - started)
+    return np, columns
+
+
+def analytics_response(compute):
+    """Run `compute(np, columns)` on the requested slice and time it."""
+    try:
+        start_date = end_date = None
+        if request.args.get("start") or request.args.get("end"):
+            start_date, end_date = parse_date_range(request.args.get("start"), request.args.get("end"))
+    except ValueError:
+        return jsonify({"error": "start and end must be YYYY-MM-DD dates, start <= end"}), 400
+    try:
+        np, columns = load_facts_columns(start_date, end_date)
+    except ImportError:
+        return jsonify({"error": "analytics need NumPy installed"}), 501
+    started = time.perf_counter()
+    try:
+        result = compute(np, columns)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify(
+        {**result, "rows": len(columns["date"]), "compute_ms": round((time.perf_counter() - started) * 1000, 3)}
+    )
+
+
+def counts_and_sums(np, codes, size, columns):
+    """Consultations, diagnostic codes and procedures per group code."""
+    return {
+        "consultations": np.bincount(codes, minlength=size).tolist(),
+        "num_diagnostic_codes": np.bincount(codes, columns["num_diagnostic_codes"], minlength=size).astype(int).tolist(),
+        "num_procedures": np.bincount(codes, columns["num_procedures"], minlength=size).astype(int).tolist(),
+    }
+
+
+@app.route("/api/analytics/by_year", methods=["GET"])
+@read_only
+def analytics_by_year():
+    def compute(np, columns):
+        years, codes = np.unique(columns["date"].astype("datetime64[Y]").astype(int) + 1970, return_inverse=True)
+        return {"year": years.tolist(), **counts_and_sums(np, codes, len(years), columns)}
+    return analytics_response(compute)
+
+
+@app.route("/api/analytics/top_clients", methods=["GET"])
+@read_only
+def analytics_top_clients():
+    """The `n` clients with most consultations."""
+    n = max(request.args.get("n", 10, type=int), 1)
+
+    def compute(np, columns):
+        counts = np.bincount(columns["vat"], minlength=len(columns["vat_labels"]))
+        top = np.argpartition(-counts, min(n, len(counts)) - 1)[:n] if len(counts) else counts
+        top = top[np.lexsort((columns["vat_labels"][top], -counts[top]))]
+        return {"vat": columns["vat_labels"][top].tolist(), "consultations": counts[top].tolist()}
+    return analytics_response(compute)
+
+
+@app.route("/api/analytics/by_zip", methods=["GET"])
+@read_only
+def analytics_by_zip():
+    """Rollup by zip prefix; `digits` (default 4) keeps the postal area only."""
+    digits = max(request.args.get("digits", 4, type=int), 1)
+
+    def compute(np, columns):
+        # Prefix the few unique labels, then map every row through its zip code
+        prefixes, prefix_of_zip = np.unique(
+            np.array([label[:digits] for label in columns["zip_labels"]], dtype=str), return_inverse=True
+        )
+        codes = prefix_of_zip[columns["zip"]]
+        return {"zip": prefixes.tolist(), **counts_and_sums(np, codes, len(prefixes), columns)}
+    return analytics_response(compute)
+
+
+@app.route("/api/analytics/histogram", methods=["GET"])
+@read_only
+def analytics_histogram():
+    """Consultations per value of `field`: num_diagnostic_codes, num_procedures, month or weekday."""
+    field = request.args.get("field", "num_diagnostic_codes")
+
+    def compute(np, columns):
+        if field in ("num_diagnostic_codes", "num_procedures"):
+            values = columns[field]
+        elif field == "month":
+            values = columns["date"].astype("datetime64[M]").astype(int) % 12 + 1
+        elif field == "weekday":
+            values = (columns["date"].astype(int) + 3) % 7  # 1970-01-01 was a Thursday; Monday is 0
+        else:
+            raise ValueError("field must be num_diagnostic_codes, num_procedures, month or weekday")
+        bins, counts = np.unique(values, return_counts=True)
+        return {"field": field, "value": bins.tolist(), "consultations": counts.tolist()}
+    return analytics_response(compute)
+
+
+# Incremental facts ETL
+#
+# Triggers append every consultation touched by a write to
+# consultation_changes, stamped with the writing transaction's id. The loader
+# only takes changes whose transaction ids are below the xmin of its snapshot,
+# i.e. whose transactions have all finished, in (xid, id) order past the
+# persisted watermark. A change committed late can therefore never fall
+# behind the watermark, as it could with a plain id or timestamp.
+FACTS_CHANNEL = "facts_consultations"
+
+queries.register("facts_changes", """
+    SELECT c.xid::text AS xid, c.id, c.VAT_doctor, c.date_timestamp, c.changed_at
+    FROM consultation_changes c
+    JOIN etl_watermark w ON w.name = 'facts_consultations'
+    WHERE (c.xid, c.id) > (w.last_xid, w.last_id)
+      AND c.xid < pg_snapshot_xmin(pg_current_snapshot())
+    ORDER BY c.xid, c.id
+    LIMIT %(batch_size)s;
+""")
+
+
+queries.register("upsert_facts", """
+    WITH changed AS (
+        SELECT DISTINCT VAT_doctor, date_timestamp
+        FROM unnest(%(vat_doctors)s::text[], %(dates)s::timestamp[]) AS k(VAT_doctor, date_timestamp)
+    ),
+    removed AS (
+        DELETE FROM facts_consultations f
+        USING changed k
+        WHERE f.VAT_doctor = k.VAT_doctor AND f.date_timestamp = k.date_timestamp
+          AND NOT EXISTS (
+            SELECT 1 FROM consultation c
+            WHERE c.VAT_doctor = k.VAT_doctor AND c.date_timestamp = k.date_timestamp
+          )
+    )
+    INSERT INTO facts_consultations (VAT, date, zip, num_diagnostic_codes, num_procedures, VAT_doctor, date_timestamp)
+    SELECT a.VAT_client, c.date_timestamp::date, cl.zip,
+           (SELECT COUNT(*) FROM consultation_diagnostic d
+            WHERE d.VAT_doctor = c.VAT_doctor AND d.date_timestamp = c.date_timestamp),
+           (SELECT COUNT(*) FROM procedure_in_consultation p
+            WHERE p.VAT_doctor = c.VAT_doctor AND p.date_timestamp = c.date_timestamp),
+           c.VAT_doctor, c.date_timestamp
+    FROM changed k
+    JOIN consultation c ON c.VAT_doctor = k.VAT_doctor AND c.date_timestamp = k.date_timestamp
+    JOIN appointment a ON a.VAT_doctor = c.VAT_doctor AND a.date_timestamp = c.date_timestamp
+    JOIN client cl ON cl.VAT = a.VAT_client
+    ON CONFLICT (VAT_doctor, date_timestamp) DO UPDATE
+    SET VAT = EXCLUDED.VAT, date = EXCLUDED.date, zip = EXCLUDED.zip,
+        num_diagnostic_codes = EXCLUDED.num_diagnostic_codes, num_procedures = EXCLUDED.num_procedures;
+""")
+
+
+queries.register("advance_facts_watermark", """
+    WITH advanced AS (
+        UPDATE etl_watermark
+        SET last_xid = %(xid)s::xid8, last_id = %(id)s, updated_at = now()
+        WHERE name = 'facts_consultations'
+        RETURNING last_xid, last_id
+    )
+    DELETE FROM consultation_changes c
+    USING advanced w
+    WHERE (c.xid, c.id) <= (w.last_xid, w.last_id);
+""")
+
+
+def load_facts_batch(batch_size=1000):
+    """Move up to `batch_size` logged changes into facts_consultations.
+
+    Returns (changes processed, lag in seconds of the newest one). The
+    watermark row is locked for the transaction, so concurrent loaders queue.
+    """
+    ensure_pools_open()
+    with pool.connection() as conn, conn.transaction(), conn.cursor(row_factory=namedtuple_row) as cur:
+        cur.execute("SELECT 1 FROM etl_watermark WHERE name = 'facts_consultations' FOR UPDATE;")
+        changes = queries.execute(
+            cur, "facts_changes",
+            {"batch_size": batch_size}
+        ).fetchall()
+        if not changes:
+            return 0, 0.0
+        queries.execute(
+            cur, "upsert_facts",
+            {"vat_doctors": [c.vat_doctor for c in changes], "dates": [c.date_timestamp for c in changes]}
+        )
+        queries.execute(
+            cur, "advance_facts_watermark",
+            {"xid": changes[-1].xid, "id": changes[-1].id}
+        )
+    return len(changes), (datetime.now(timezone.utc) - changes[-1].changed_at).total_seconds()
+
+
+def run_facts_etl(batch_size=1000):
+    """Load batches until caught up, then refresh and announce the aggregates."""
+    started = time.perf_counter()
+    loaded, lag = 0, 0.0
+    while True:
+        count, batch_lag = load_facts_batch(batch_size)
+        if not count:
+            break
+        loaded, lag = loaded + count, batch_lag
+        metrics.inc("etl_facts_changes_total", count)
+    if loaded:
+        refresh_dashboard_aggregates()
+    elapsed = time.perf_counter() - started
+    return {
+        "changes": loaded,
+        "seconds": round(elapsed, 3),
+        "rows_per_second": round(loaded / elapsed) if elapsed else 0,
+        "lag_seconds": round(lag, 3),
+    }
+
+
+def announce_facts():
+    """Tell every worker, through its listener, that dashboard data changed."""
+    with pool.connection() as conn:
+        conn.execute("SELECT pg_notify(%s, '');", (FACTS_CHANNEL,))
+    facts_loaded()
+
+
+def facts_loaded():
+    """Drop this worker's cached dashboard data after the ETL loaded facts."""
+    dashboard_stats_cache.clear()
+    response_cache.bump("facts")  # every worker gets the NOTIFY itself
+
+
+@app.cli.command("etl-facts")
+@click.option("--batch-size", default=1000, show_default=True)
+@click.option("--follow", is_flag=True, help="Keep polling for changes instead of exiting once caught up.")
+@click.option("--interval", default=1.0, show_default=True, help="Seconds between polls with --follow.")
+@click.option("--backfill", is_flag=True, help="Queue every consultation, replacing facts loaded by other means.")
+def etl_facts_command(batch_size, follow, interval, backfill):
+    """Incrementally load facts_consultations from the consultation tables."""
+    ensure_pools_open()
+    if backfill:
+        with pool.connection() as conn, conn.transaction():
+            conn.execute("DELETE FROM facts_consultations WHERE VAT_doctor IS NULL;")
+            conn.execute(
+                "INSERT INTO consultation_changes (VAT_doctor, date_timestamp) SELECT VAT_doctor, date_timestamp FROM consultation;"
+            )
+    while True:
+        report = run_facts_etl(batch_size)
+        if report["changes"] or not follow:
+            click.echo(
+                f"Loaded {report['changes']} changed consultations in {report['seconds']}s "
+                f"({report['rows_per_second']} changes/s), lag {report['lag_seconds']}s."
+            )
+        if not follow:
+            break
+        time.sleep(interval)
+
+
+# Background jobs
+#
+# Reports and exports are queued in the jobs table and run by
+# `flask jobs-worker`, a pool of worker processes. Jobs are claimed with
+# SELECT ... FOR UPDATE SKIP LOCKED, so any number of workers share the queue
+# without waiting on each other. Results are written under
+# FLASK_JOB_RESULT_DIR and downloaded from /jobs/<id>/result.
+#
+# FLASK_JOB_CONCURRENCY, FLASK_JOB_MAX_ATTEMPTS and FLASK_JOB_RETRY_DELAY are
+# numbers, or JSON objects mapping job types to numbers.
+JOB_TYPES = {}
+
+
+def job(name):
+    """Register a job handler, called as handler(params, path, progress).
+
+    The handler writes its result file to `path`, may call progress(fraction)
+    and returns a JSON-able summary; "filename" and "mimetype" in it are used
+    for the download. A ValueError marks the job failed without retrying.
+    """
+    def decorator(handler):
+        JOB_TYPES[name] = handler
+        return handler
+    return decorator
+
+
+def job_setting(name, job_type, default):
+    value = app.config.get(f"JOB_{name}", default)
+    return value.get(job_type, default) if isinstance(value, dict) else value
+
+
+def job_result_path(job_id):
+    result_dir = app.config.get("JOB_RESULT_DIR", os.path.join(app.instance_path, "jobs"))
+    os.makedirs(result_dir, exist_ok=True)
+    return os.path.join(result_dir, f"job-{job_id}")
+
+
+@job("consultations_export")
+def consultations_export_job(params, path, progress):
+    start_date, end_date = parse_date_range(params.get("start"), params.get("end"))
+    with db_cursor() as cur:
+        total = cur.execute(
+            "SELECT COUNT(*) FROM facts_consultations WHERE date BETWEEN %s AND %s;", (start_date, end_date)
+        ).fetchone()[0]
+    written = 0
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(("vat", "date", "zip", "num_diagnostic_codes", "num_procedures"))
+        for row in get_consultations_between_dates(start_date, end_date):
+            writer.writerow(row)
+            written += 1
+            if written % 10000 == 0:
+                progress(written / total)
+    return {"rows": written, "filename": f"consultations_{start_date}_{end_date}.csv", "mimetype": "text/csv"}
+
+
+@job("clients_export")
+def clients_export_job(params, path, progress):
+    with db_cursor() as cur, open(path, "wb") as f:
+        with cur.copy("COPY client TO STDOUT WITH (FORMAT csv, HEADER true)") as copy:
+            for data in copy:
+                f.write(data)
+        rows = cur.rowcount
+    return {"rows": rows, "filename": "clients.csv", "mimetype": "text/csv"}
+
+
+@job("dashboard_refresh")
+def dashboard_refresh_job(params, path, progress):
+    return {"refreshed": refresh_dashboard_aggregates()}
+
+
+def update_job(job_id, query, params=()):
+    """Write job state on its own connection, so it is visible at once."""
+    ensure_pools_open()
+    with pool.connection() as conn:
+        conn.execute(query, (*params, job_id))
+
+
+def claim_job(job_types):
+    """Mark the oldest runnable job of one of `job_types` as running."""
+    with pool.connection() as conn, conn.cursor(row_factory=namedtuple_row) as cur:
+        return cur.execute(
+            """
+            UPDATE jobs
+            SET status = 'running', attempts = attempts + 1, started_at = now(), heartbeat_at = now()
+            WHERE id = (
+                SELECT id
+                FROM jobs
+                WHERE status = 'queued' AND run_after <= now() AND type = ANY(%s)
+                ORDER BY run_after, id
+                LIMIT 1
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, type;
+            """,
+            (job_types,)
+        ).fetchone()
+
+
+def run_job(job_id):
+    """Run one claimed job in a worker process and record how it ended."""
+    with app.app_context():
+        with db_cursor() as cur:
+            claimed = cur.execute("SELECT type, params, attempts FROM jobs WHERE id = %s;", (job_id,)).fetchone()
+        path = job_result_path(job_id)
+        last_progress = 0.0
+
+        def progress(fraction):
+            nonlocal last_progress
+            if time.monotonic() - last_progress >= 1:
+                last_progress = time.monotonic()
+                update_job(job_id, "UPDATE jobs SET progress = %s, heartbeat_at = now() WHERE id = %s;", (fraction,))
+
+        started = time.perf_counter()
         try:
-            with psycopg2.connect(conninfo=DATABASE_URL) as conn:
-                with connection.cursor(row_factory=namedtuple_row) as cur:
-                    consults_by_year = cur.execute(
-                        """
-                            SELECT Extract(YEAR FROM date) as year ,COUNT(*) as total_consultations 
-                            FROM facts_consultations
-                            GROUP BY Extract(YEAR FROM date)
-                            ORDER BY Extract(YEAR FROM date)
-                        """
-                    ).fetchall()
+            result = JOB_TYPES[claimed.type](claimed.params, path, progress)
+        except Exception as e:
+            retry = not isinstance(e, ValueError) and claimed.attempts < job_setting("MAX_ATTEMPTS", claimed.type, 3)
+            log.warning(f"Job {job_id} ({claimed.type}) failed on attempt {claimed.attempts}: {e}")
+            update_job(
+                job_id,
+                """
+                UPDATE jobs
+                SET status = %s, error = %s, run_after = now() + %s * interval '1 second'
+                WHERE id = %s;
+                """,
+                ("queued" if retry else "failed", str(e), job_setting("RETRY_DELAY", claimed.type, 30) * claimed.attempts),
+            )
+            return
+        update_job(
+            job_id,
+            "UPDATE jobs SET status = 'done', progress = 1, result = %s, error = NULL, finished_at = now() WHERE id = %s;",
+            (Jsonb(result),),
+        )
+        log.info(f"Job {job_id} ({claimed.type}) done in {time.perf_counter() - started:.1f}s.")
+
+
+def recover_jobs(running_ids, lost_ids=()):
+    """Heartbeat our running jobs and requeue ones whose worker went away.
+
+    `lost_ids` are jobs this worker knows were lost (their process died or
+    they were never submitted), requeued now rather than once they go stale.
+    """
+    with pool.connection() as conn:
+        conn.execute("UPDATE jobs SET heartbeat_at = now() WHERE id = ANY(%s);", (running_ids,))
+        conn.execute(
+            """
+            UPDATE jobs
+            SET status = CASE WHEN attempts >= COALESCE((%s::jsonb ->> type)::int, %s) THEN 'failed' ELSE 'queued' END,
+                error = 'worker lost'
+            WHERE status = 'running' AND (heartbeat_at < now() - %s * interval '1 second' OR id = ANY(%s));
+            """,
+            (
+                Jsonb({job_type: job_setting("MAX_ATTEMPTS", job_type, 3) for job_type in JOB_TYPES}),
+                job_setting("MAX_ATTEMPTS", None, 3),
+                app.config.get("JOB_STALE_SECONDS", 300),
+                list(lost_ids),
+            )
+        )
+
+
+@app.cli.command("jobs-worker")
+@click.option("--processes", default=os.cpu_count() or 2, show_default=True)
+@click.option("--poll-interval", default=1.0, show_default=True)
+def jobs_worker(processes, poll_interval):
+    """Run queued background jobs in a pool of worker processes."""
+    ensure_pools_open()
+    running = {}  # future -> (job id, job type)
+    lost = []
+    context = multiprocessing.get_context("spawn")
+    executor = ProcessPoolExecutor(processes, mp_context=context)
+    try:
+        while True:
+            broken = False
+            for future in [future for future in running if future.done()]:
+                job_id, job_type = running.pop(future)
+                if future.exception() is not None:
+                    log.error(f"Job {job_id} ({job_type}) crashed its worker: {future.exception()}")
+                    lost.append(job_id)
+                    broken = broken or isinstance(future.exception(), BrokenProcessPool)
+            if broken:
+                # A dead child (e.g. OOM-killed) breaks the pool for good
+                executor.shutdown(wait=False)
+                executor = ProcessPoolExecutor(processes, mp_context=context)
+            recover_jobs([job_id for job_id, _ in running.values()], lost)
+            lost.clear()
+
+            busy = Counter(job_type for _, job_type in running.values())
+            free = [job_type for job_type in JOB_TYPES if busy[job_type] < job_setting("CONCURRENCY", job_type, 1)]
+            claimed = claim_job(free) if free and len(running) < processes else None
+            if claimed is not None:
+                try:
+                    running[executor.submit(run_job, claimed.id)] = (claimed.id, claimed.type)
+                except BrokenProcessPool:
+                    log.error(f"Worker pool broken, requeueing job {claimed.id} ({claimed.type})")
+                    lost.append(claimed.id)
+                    executor.shutdown(wait=False)
+                    executor = ProcessPoolExecutor(processes, mp_context=context)
+            elif running:
+                wait(running, timeout=poll_interval, return_when=FIRST_COMPLETED)
+            else:
+                time.sleep(poll_interval)
+    finally:
+        executor.shutdown()
+
+
+@app.route("/jobs", methods=["POST"])
+def enqueue_job():
+    """Queue a job given as JSON {"type": ..., "params": {...}}."""
+    body = request.get_json(silent=True) or {}
+    if body.get("type") not in JOB_TYPES:
+        return jsonify({"error": f"type must be one of {sorted(JOB_TYPES)}"}), 400
+    if not isinstance(body.get("params", {}), dict):
+        return jsonify({"error": "params must be an object"}), 400
+    with db_cursor() as cur:
+        job_id = cur.execute(
+            "INSERT INTO jobs (type, params) VALUES (%s, %s) RETURNING id;", (body["type"], Jsonb(body.get("params", {})))
+        ).fetchone().id
+    status_url = url_for("job_status", job_id=job_id)
+    return jsonify({"id": job_id, "status": "queued", "url": status_url}), 202, {"Location": status_url}
+
+
+@app.route("/jobs/<int:job_id>", methods=["GET"])
+def job_status(job_id):
+    with db_cursor() as cur:
+        found = cur.execute(
+            """
+            SELECT id, type, params, status, attempts, progress, result, error,
+                   created_at, started_at, finished_at
+            FROM jobs
+            WHERE id = %s;
+            """,
+            (job_id,)
+        ).fetchone()
+    if found is None:
+        return jsonify({"error": "no such job"}), 404
+    status = {key: value.isoformat() if isinstance(value, datetime) else value for key, value in found._asdict().items()}
+    if found.status == "done" and (found.result or {}).get("filename"):
+        status["download_url"] = url_for("job_result", job_id=job_id)
+    return jsonify(status)
+
+
+@app.route("/jobs/<int:job_id>/result", methods=["GET"])
+def job_result(job_id):
+    with db_cursor() as cur:
+        found = cur.execute("SELECT result FROM jobs WHERE id = %s AND status = 'done';", (job_id,)).fetchone()
+    path = job_result_path(job_id)
+    if found is None or not (found.result or {}).get("filename") or not os.path.exists(path):
+        return jsonify({"error": "no result for this job"}), 404
+    return send_file(
+        path, mimetype=found.result.get("mimetype"), as_attachment=True, download_name=found.result["filename"]
+    )
 
-        except psycopg2.Error as e:
-            print(f"Database error: {e}")
 
-        
+startup_times["import"] = time.perf_counter() - IMPORT_STARTED
 
-        return render_template('dashboard.html', consults_by_year=consults_by_year)
-                    
 
 if __name__ == "__main__":
-    app.run()
\ No newline at end of file
+    create_app().run()
\ No newline at end of file
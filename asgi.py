@@ -0,0 +1,297 @@
+#!/usr/bin/python3
+# Copyright (c) BDist Development Team
+# Distributed under the terms of the Modified BSD License.
+"""Async (ASGI) serving mode.
+
+The front-desk routes (client search, booking, availability, appointment
+history and consultation details) are served by a Quart app on an
+AsyncConnectionPool, so a worker waiting on Postgres keeps serving other
+sessions. Every other URL is handed to the WSGI app in app.py, which keeps
+the two modes on the same SQL, templates and configuration.
+
+The async routes share app.py's version stamps (ETags, 304s and the
+response cache), its /metrics counters and its read-your-writes session
+stamp. They do not use the read replicas: every query goes to the primary
+(FLASK_DATABASE_URL), so these pages add load there even when
+FLASK_DATABASE_REPLICA_URLS is set.
+
+Run with any ASGI server, e.g. `hypercorn asgi:application`.
+"""
+import asyncio
+import functools
+import time
+from datetime import datetime
+
+from asgiref.wsgi import WsgiToAsgi
+from psycopg.errors import ExclusionViolation, UniqueViolation
+from psycopg.rows import namedtuple_row
+from psycopg_pool import AsyncConnectionPool
+from quart import (
+    Quart,
+    Response,
+    flash,
+    g,
+    has_request_context,
+    make_response,
+    render_template,
+    request,
+    session,
+    url_for,
+)
+from werkzeug.exceptions import HTTPException
+
+import app as clinic
+
+app = Quart(__name__)
+app.config.from_prefixed_env("FLASK")
+app.url_map.converters["timestamp"] = clinic.TimestampConverter
+log = app.logger
+
+pool = AsyncConnectionPool(
+    conninfo=app.config.get("DATABASE_URL", clinic.DATABASE_URL),
+    min_size=app.config.get("POOL_MIN_SIZE", 4),
+    max_size=app.config.get("POOL_MAX_SIZE", 16),
+    timeout=app.config.get("POOL_TIMEOUT", 10),
+    max_idle=app.config.get("POOL_MAX_IDLE", 600),
+    check=AsyncConnectionPool.check_connection,
+    kwargs={"autocommit": True},
+    name="clinic-async",
+    open=False,
+)
+
+
+@app.before_serving
+async def open_pool():
+    """Warm both halves up before the server accepts connections."""
+    clinic.create_app()
+    clinic.reference_data.start_listener()  # also without FLASK_WARM_UP
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+    await pool.open(wait=True, timeout=app.config.get("POOL_TIMEOUT", 10))
+
+
+@app.after_serving
+async def close_pool():
+    await pool.close()
+
+
+@app.before_request
+async def start_request_timer():
+    g.request_started = time.perf_counter()
+
+
+@app.teardown_request
+async def record_request_time(exception):
+    started = g.pop("request_started", None)
+    if started is not None:
+        clinic.metrics.observe(
+            "http_request_duration_seconds", time.perf_counter() - started,
+            route=current_route(), method=request.method,
+        )
+
+
+def current_route():
+    return (request.endpoint or "unknown") if has_request_context() else "background"
+
+
+async def fetch(query, params=None, one=False):
+    """Run one statement on a pooled async connection, as a prepared statement."""
+    async with pool.connection() as conn:
+        async with conn.transaction():
+            async with conn.cursor(row_factory=namedtuple_row) as cur:
+                started = time.perf_counter()
+                await cur.execute(query, params, prepare=app.config.get("PREPARED_STATEMENTS", True))
+                route = current_route()
+                clinic.metrics.observe(
+                    "db_query_duration_seconds", time.perf_counter() - started,
+                    route=route, statement=clinic.statement_label(cur, query),
+                )
+                clinic.metrics.inc("db_queries_total", route=route)
+                if cur.rowcount >= 0:
+                    clinic.metrics.inc("db_rows_total", cur.rowcount, route=route)
+                return await (cur.fetchone() if one else cur.fetchall())
+
+
+def conditional(*version_keys, time_bucket=None):
+    """Async twin of clinic.conditional(), on the same version stamps and cache.
+
+    Every query here runs on the primary, so any 200 page may be stored.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        async def wrapper(**kwargs):
+            if request.method != "GET" or "_flashes" in session:
+                return await view(**kwargs)
+            etag = clinic.version_etag(request.full_path, version_keys, kwargs, time_bucket)
+            if etag in request.if_none_match:
+                response = Response("", status=304)
+            else:
+                cached = clinic.response_cache.get(etag)
+                if cached is not None:
+                    mimetype, body = cached
+                    response = Response(body, mimetype=mimetype)
+                else:
+                    response = await make_response(await view(**kwargs))
+                    if response.status_code != 200:
+                        return response
+                    clinic.response_cache.set(etag, (response.mimetype, await response.get_data()))
+            response.set_etag(etag)
+            response.headers["Cache-Control"] = "no-cache"
+            return response
+        return wrapper
+    return decorator
+
+
+@app.route("/search_clients", methods=("GET", "POST"))
+async def search_clients():
+    """Show the matching clients, alphabetical order, one page at a time."""
+    values = await request.values
+    criteria = {field: values.get(field, "").strip() for field in clinic.CLIENT_SEARCH_FIELDS}
+    criteria = {field: value for field, value in criteria.items() if value}
+    after = None
+    if values.get("after_name") is not None and values.get("after_vat"):
+        after = (values["after_name"], values["after_vat"])
+    page_size = app.config.get("SEARCH_PAGE_SIZE", 50)
+
+    if criteria:
+        query, params = clinic.build_client_search(criteria, after, page_size + 1)
+        clients = await fetch(query, params)
+
+        next_page = None
+        if len(clients) > page_size:
+            clients = clients[:page_size]
+            next_page = url_for(
+                "search_clients", **criteria, after_name=clients[-1].name, after_vat=clients[-1].vat
+            )
+
+        if clients:
+            return await render_template(
+                "search_clients.html", vat=criteria.get("vat"), clients=clients, next_page=next_page
+            )
+        await flash("No clients found.")
+    else:
+        await flash("No values inserted.")
+    return await render_template("search_clients.html")
+
+
+@app.route("/appointments/<vat>", methods=["GET", "POST"])
+async def new_appointment(vat):
+    if request.method == "POST":
+        form = await request.form
+        try:
+            appointment_datetime = datetime.strptime(f"{form.get('date')} {form.get('time')}", "%Y-%m-%d %H:%M")
+        except ValueError:
+            await flash("Invalid date or time.")
+            return await render_template("new_appointment.html", vat=vat)
+
+        try:
+            booked = await fetch(
+                clinic.BOOK_APPOINTMENT_QUERY,
+                {
+                    "appointment_datetime": appointment_datetime,
+                    "doctor_vat": form.get("doctorvat"),
+                    "vat": vat,
+                    "description": form.get("description"),
+                },
+                one=True,
+            )
+        except (ExclusionViolation, UniqueViolation):
+            await flash("Overlapping appointments for the selected doctor. Choose a different time.")
+            return await render_template("new_appointment.html", vat=vat)
+
+        if booked:
+            # bump_versions() may NOTIFY on the sync pool, so keep it off the event loop
+            await asyncio.to_thread(clinic.bump_versions, f"appointments:{vat}", "appointments")
+            session["wrote_at"] = time.time()  # later reads of this session go to the primary
+            await flash("New appointment registered successfuly!")
+        else:
+            await flash("Incorrect Doctor VAT inserted")
+    return await render_template("new_appointment.html", vat=vat)
+
+
+@app.route("/available_doctors", methods=["GET", "POST"])
+@conditional("appointments")
+async def available_doctors():
+    # Also answers GET ?date=&time=, like the WSGI view
+    if request.method == "POST" or "date" in request.args:
+        values = await request.values
+        date, time = values.get("date"), values.get("time")
+        try:
+            start_time = datetime.strptime(f"{date} {time}", "%Y-%m-%d %H:%M")
+        except ValueError:
+            await flash("Invalid date or time.")
+            return await render_template("available_doctors.html")
+
+        doctors = await fetch(
+            clinic.AVAILABLE_DOCTORS_QUERY,
+            {"start_time": start_time, "end_time": start_time + clinic.APPOINTMENT_LENGTH},
+        )
+        return await render_template("available_doctors.html", date=date, time=time, available_doctors=doctors)
+
+    return await render_template("available_doctors.html")
+
+
+@app.route("/client/<vat>/appointments", methods=["GET"])
+# Appointments move from upcoming to past as time goes by
+@conditional("appointments:{vat}", "consultations", time_bucket=60)
+async def client_appointments(vat):
+    page_size = app.config.get("APPOINTMENTS_PAGE_SIZE", 20)
+    params = clinic.client_appointments_params(vat, request.args, page_size)
+    rows = await fetch(clinic.CLIENT_APPOINTMENTS_QUERY, params)
+
+    upcoming, past, after, before = clinic.paginate_client_appointments(rows, page_size)
+    return await render_template(
+        "client_appointments.html",
+        vat=vat,
+        appointments=upcoming + past,
+        upcoming=upcoming,
+        past=past,
+        next_upcoming=after and url_for("client_appointments", vat=vat, scope="upcoming", after=after),
+        next_past=before and url_for("client_appointments", vat=vat, scope="past", before=before),
+    )
+
+
+@app.route("/consultation_details/<vat_doctor>/<timestamp:consultation_date>")
+@conditional("consultation:{vat_doctor}:{consultation_date}")
+async def consultation_details(vat_doctor, consultation_date):
+    details = clinic.consultation_cache.get((vat_doctor, consultation_date))
+    if details is None:
+        row = await fetch(
+            clinic.CONSULTATION_DETAILS_QUERY,
+            {"vat_doctor": vat_doctor, "date_timestamp": consultation_date},
+            one=True,
+        )
+        details = row._asdict()
+        clinic.consultation_cache.set((vat_doctor, consultation_date), details)
+
+    return await render_template(
+        "consultation_details.html",
+        vat_doctor=vat_doctor,
+        consultation_date=consultation_date,
+        **details,
+    )
+
+
+ASYNC_ENDPOINTS = frozenset(app.view_functions) - {"static"}
+
+# Register the remaining routes without views so url_for() in the shared
+# templates can build them; requests for them are dispatched to app.py.
+for rule in clinic.app.url_map.iter_rules():
+    if rule.endpoint not in app.view_functions:
+        app.add_url_rule(rule.rule, endpoint=rule.endpoint, methods=rule.methods)
+
+wsgi_app = WsgiToAsgi(clinic.app)
+
+
+async def application(scope, receive, send):
+    """Dispatch async endpoints to Quart and everything else to the WSGI app."""
+    if scope["type"] == "http":
+        adapter = app.url_map.bind("")
+        try:
+            endpoint, _ = adapter.match(scope["path"], method=scope["method"])
+        except HTTPException:
+            endpoint = None
+        if endpoint not in ASYNC_ENDPOINTS:
+            await wsgi_app(scope, receive, send)
+            return
+    await app(scope, receive, send)
@@ -0,0 +1,402 @@
+#!/usr/bin/python3
+# Copyright (c) BDist Development Team
+# Distributed under the terms of the Modified BSD License.
+"""Load-test and benchmark harness for the clinic app.
+
+Seed a local database with synthetic clinic data:
+
+    python bench.py seed --dsn postgres://db:db@localhost/db --clients 100000
+
+Replay a request mix against a running server and compare with a baseline:
+
+    python bench.py run --url http://localhost:5000 --dsn ... --duration 60 \\
+        --save-baseline baseline.json
+    python bench.py run --url http://localhost:5000 --dsn ... --baseline baseline.json
+
+Latency percentiles and throughput are measured client side. DB round
+trips per request are read from the db_queries_total counters on /metrics.
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+
+import psycopg
+
+FIRST_NAMES = ("Ana", "João", "Maria", "Pedro", "Inês", "Tiago", "Rita", "Rui", "Sofia", "Miguel")
+LAST_NAMES = ("Silva", "Santos", "Ferreira", "Pereira", "Oliveira", "Costa", "Rodrigues", "Martins")
+CITIES = ("Lisbon", "Porto", "Braga", "Coimbra", "Faro", "Aveiro", "Évora", "Setúbal")
+DIAGNOSES = ("gingivitis", "caries", "periodontitis", "tooth fracture", "abscess", "bruxism", "malocclusion")
+
+
+def person_name(rng):
+    return f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)} {rng.choice(LAST_NAMES)}"
+
+
+def synthetic_value(column, i):
+    """Placeholder for a NOT NULL column the seeder does not know about."""
+    data_type, max_length = column["data_type"], column["character_maximum_length"]
+    if data_type in ("integer", "bigint", "smallint", "numeric", "real", "double precision"):
+        return i % 1000
+    if data_type in ("character varying", "character", "text"):
+        value = f"x{i}"
+        return value[:max_length] if max_length else value
+    if data_type == "date":
+        return "2000-01-01"
+    if data_type.startswith("timestamp"):
+        return "2000-01-01 00:00:00"
+    if data_type == "boolean":
+        return False
+    return None
+
+
+def copy_rows(conn, table, rows):
+    """COPY dict rows into `table`, filling unknown NOT NULL columns."""
+    rows = list(rows)
+    if not rows:
+        return 0
+    columns = conn.execute(
+        """
+        SELECT column_name, data_type, character_maximum_length,
+               is_nullable = 'NO' AND column_default IS NULL AND is_generated = 'NEVER' AS required
+        FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = %s
+        ORDER BY ordinal_position
+        """,
+        (table,),
+    ).fetchall()
+    columns = [dict(zip(("name", "data_type", "character_maximum_length", "required"), c)) for c in columns]
+    given = list(rows[0])
+    extra = [c for c in columns if c["required"] and c["name"] not in given]
+    names = given + [c["name"] for c in extra]
+
+    with conn.cursor() as cur:
+        with cur.copy(f"COPY {table} ({', '.join(names)}) FROM STDIN") as copy:
+            for i, row in enumerate(rows):
+                copy.write_row([row[name] for name in given] + [synthetic_value(c, i) for c in extra])
+    return len(rows)
+
+
+def seed(args):
+    rng = random.Random(args.seed)
+    today = date.today()
+    started = time.perf_counter()
+
+    employees = [
+        {"vat": str(100000000 + i), "name": person_name(rng)} for i in range(args.doctors + args.nurses)
+    ]
+    doctors = [e["vat"] for e in employees[: args.doctors]]
+    nurses = [e["vat"] for e in employees[args.doctors:]]
+    clients = [
+        {
+            "vat": str(200000000 + i),
+            "name": person_name(rng),
+            "birth_date": today - timedelta(days=rng.randint(365 * 5, 365 * 90)),
+            "street": f"Rua {rng.choice(LAST_NAMES)}, {rng.randint(1, 300)}",
+            "city": rng.choice(CITIES),
+            "zip": f"{rng.randint(1000, 9999)}-{rng.randint(0, 999):03d}",
+            "gender": rng.choice("MF"),
+        }
+        for i in range(args.clients)
+    ]
+    codes = [{"id": i + 1, "description": f"{rng.choice(DIAGNOSES)} #{i + 1}"} for i in range(args.diagnostic_codes)]
+    medications = [{"name": f"med{i}", "lab": f"lab{i % 25}"} for i in range(args.medications)]
+
+    appointments, consultations, assistants, diagnostics, prescriptions, facts = [], [], [], [], [], []
+    taken = set()
+    start = datetime.combine(today - timedelta(days=365 * args.years), datetime.min.time())
+    for client in clients:
+        for _ in range(args.appointments_per_client):
+            # Whole hours inside clinic hours, so one-hour slots never overlap
+            while True:
+                day = start + timedelta(days=rng.randint(0, 365 * args.years + 60))
+                timestamp = day.replace(hour=rng.randint(9, 16))
+                doctor = rng.choice(doctors)
+                if (doctor, timestamp) not in taken:
+                    taken.add((doctor, timestamp))
+                    break
+            appointments.append(
+                {"date_timestamp": timestamp, "vat_doctor": doctor, "vat_client": client["vat"],
+                 "description": rng.choice(DIAGNOSES)}
+            )
+            if timestamp.date() >= today or rng.random() > args.attendance:
+                continue
+            consultations.append(
+                {"vat_doctor": doctor, "date_timestamp": timestamp, "soap_s": "patient reports pain",
+                 "soap_o": "swelling observed", "soap_a": rng.choice(DIAGNOSES), "soap_p": "follow-up"}
+            )
+            for nurse in rng.sample(nurses, min(len(nurses), rng.randint(0, 2))):
+                assistants.append({"vat_doctor": doctor, "date_timestamp": timestamp, "vat_nurse": nurse})
+            consultation_codes = rng.sample(codes, min(len(codes), rng.randint(1, 2)))
+            for code in consultation_codes:
+                diagnostics.append({"vat_doctor": doctor, "date_timestamp": timestamp, "id": code["id"]})
+                if rng.random() < 0.5:
+                    med = rng.choice(medications)
+                    prescriptions.append(
+                        {"vat_doctor": doctor, "date_timestamp": timestamp, "id": code["id"], "name": med["name"],
+                         "lab": med["lab"], "dosage": "1/day", "description": "after meals"}
+                    )
+            facts.append(
+                {"vat": client["vat"], "date": timestamp.date(), "zip": client["zip"],
+                 "num_diagnostic_codes": len(consultation_codes), "num_procedures": 0}
+            )
+
+    with psycopg.connect(args.dsn) as conn:
+        # With the facts ETL migrated, seeded facts carry their consultation key
+        # and the change log the seeding triggers wrote is dropped afterwards
+        etl = conn.execute("SELECT to_regclass('consultation_changes') IS NOT NULL").fetchone()[0]
+        if etl:
+            for fact, consultation in zip(facts, consultations):
+                fact.update(vat_doctor=consultation["vat_doctor"], date_timestamp=consultation["date_timestamp"])
+        if args.truncate:
+            conn.execute(
+                """
+                TRUNCATE facts_consultations, prescription, consultation_diagnostic, consultation_assistant,
+                         consultation, appointment, medication, diagnostic_code, client, nurse, doctor, employee
+                CASCADE
+                """
+            )
+        counts = {
+            "employee": copy_rows(conn, "employee", employees),
+            "doctor": copy_rows(conn, "doctor", [{"vat": vat} for vat in doctors]),
+            "nurse": copy_rows(conn, "nurse", [{"vat": vat} for vat in nurses]),
+            "client": copy_rows(conn, "client", clients),
+            "diagnostic_code": copy_rows(conn, "diagnostic_code", codes),
+            "medication": copy_rows(conn, "medication", medications),
+            "appointment": copy_rows(conn, "appointment", appointments),
+            "consultation": copy_rows(conn, "consultation", consultations),
+            "consultation_assistant": copy_rows(conn, "consultation_assistant", assistants),
+            "consultation_diagnostic": copy_rows(conn, "consultation_diagnostic", diagnostics),
+            "prescription": copy_rows(conn, "prescription", prescriptions),
+            "facts_consultations": copy_rows(conn, "facts_consultations", facts),
+        }
+        if etl:
+            conn.execute("TRUNCATE consultation_changes;")
+        # Codes were copied with explicit IDs; move the sequence that `flask
+        # migrate` puts behind diagnostic_code.ID past them
+        if conn.execute("SELECT to_regclass('diagnostic_code_id_seq') IS NOT NULL").fetchone()[0]:
+            conn.execute(
+                "SELECT setval('diagnostic_code_id_seq', COALESCE((SELECT MAX(ID) FROM diagnostic_code), 0) + 1, false)"
+            )
+        conn.execute("ANALYZE;")
+
+    for table, count in counts.items():
+        print(f"{table:>24}: {count}")
+    print(f"Seeded in {time.perf_counter() - started:.1f}s")
+
+
+class Scenario:
+    """Builds requests for each route from sample keys in the database."""
+
+    def __init__(self, dsn, rng):
+        self.rng = rng
+        with psycopg.connect(dsn) as conn:
+            self.clients = conn.execute("SELECT VAT, name FROM client TABLESAMPLE SYSTEM (10) LIMIT 1000").fetchall()
+            self.doctors = [row[0] for row in conn.execute("SELECT VAT FROM doctor").fetchall()]
+            self.consultations = conn.execute(
+                "SELECT VAT_doctor, date_timestamp FROM consultation TABLESAMPLE SYSTEM (10) LIMIT 1000"
+            ).fetchall()
+        if not (self.clients and self.doctors and self.consultations):
+            raise SystemExit("The database has no clients, doctors or consultations; run `bench.py seed` first.")
+
+    def search_clients(self):
+        name = self.rng.choice(self.clients)[1]
+        return "POST", "/search_clients", {"name": name.split()[0][:4]}
+
+    def available_doctors(self):
+        day = date.today() + timedelta(days=self.rng.randint(1, 30))
+        return "POST", "/available_doctors", {"date": day.isoformat(), "time": f"{self.rng.randint(9, 16)}:00"}
+
+    def client_appointments(self):
+        return "GET", f"/client/{self.rng.choice(self.clients)[0]}/appointments", None
+
+    def consultation_details(self):
+        vat_doctor, timestamp = self.rng.choice(self.consultations)
+        return "GET", f"/consultation_details/{vat_doctor}/{urllib.parse.quote(str(timestamp))}", None
+
+    def dashboard(self):
+        return "GET", "/dashboard", None
+
+    def consultations_api(self):
+        return "GET", "/api/consultations?limit=500", None
+
+    def consultation_wizard(self):
+        # Book a far-future slot, then submit the whole consultation for it
+        vat_client = self.rng.choice(self.clients)[0]
+        vat_doctor = self.rng.choice(self.doctors)
+        when = datetime(2100, 1, 1, 9) + timedelta(days=self.rng.randint(0, 36500), hours=self.rng.randint(0, 7))
+        booking = ("POST", f"/appointments/{vat_client}",
+                   {"date": when.date().isoformat(), "time": when.strftime("%H:%M"), "doctorvat": vat_doctor,
+                    "description": "benchmark"})
+        draft = {
+            "soap": {"s": "benchmark", "o": "benchmark", "a": "benchmark", "p": "benchmark"},
+            "nurses": [],
+            "diagnostics": [{"description": self.rng.choice(DIAGNOSES),
+                             "prescriptions": [{"name": "med0", "lab": "lab0", "dosage": "1/day",
+                                                "description": "benchmark"}]}],
+        }
+        return [booking, ("POST", f"/api/consultation_draft/{vat_doctor}/{urllib.parse.quote(str(when))}", draft)]
+
+
+DEFAULT_MIX = {
+    "search_clients": 25,
+    "available_doctors": 15,
+    "client_appointments": 25,
+    "consultation_details": 25,
+    "dashboard": 3,
+    "consultations_api": 2,
+    "consultation_wizard": 5,
+}
+
+# Route label under which each scenario's queries show up on /metrics.
+METRIC_ROUTES = {
+    "search_clients": ("search_clients",),
+    "available_doctors": ("available_doctors",),
+    "client_appointments": ("client_appointments",),
+    "consultation_details": ("consultation_details",),
+    "dashboard": ("consultations_data",),
+    "consultations_api": ("consultations_api",),
+    "consultation_wizard": ("new_appointment", "submit_consultation"),
+}
+
+
+def send(base_url, method, path, payload):
+    data, headers = None, {}
+    if payload is not None and path.startswith("/api/"):
+        data, headers = json.dumps(payload).encode(), {"Content-Type": "application/json"}
+    elif payload is not None:
+        data = urllib.parse.urlencode(payload).encode()
+    req = urllib.request.Request(base_url + path, data=data, method=method, headers=headers)
+    try:
+        with urllib.request.urlopen(req, timeout=30) as response:
+            response.read()
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def query_counts(base_url):
+    """db_queries_total per route, scraped from /metrics."""
+    with urllib.request.urlopen(base_url + "/metrics", timeout=10) as response:
+        text = response.read().decode()
+    counts = defaultdict(float)
+    for match in re.finditer(r'^db_queries_total\{route="([^"]*)"\} (\S+)$', text, re.MULTILINE):
+        counts[match.group(1)] += float(match.group(2))
+    return counts
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def run(args):
+    rng = random.Random(args.seed)
+    scenario = Scenario(args.dsn, rng)
+    mix = json.loads(args.mix) if args.mix else DEFAULT_MIX
+    names, weights = zip(*mix.items())
+    latencies = defaultdict(list)
+    errors = defaultdict(int)
+    lock = threading.Lock()
+    deadline = time.monotonic() + args.duration
+
+    def worker(seed):
+        local = random.Random(seed)
+        while time.monotonic() < deadline:
+            name = local.choices(names, weights)[0]
+            batch = getattr(scenario, name)()
+            if isinstance(batch, tuple):
+                batch = [batch]
+            started = time.perf_counter()
+            statuses = [send(args.url, *req) for req in batch]
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies[name].append(elapsed)
+                # 4xx too: a rejected booking or draft is a failed request
+                if any(status >= 400 for status in statuses):
+                    errors[name] += 1
+
+    before = query_counts(args.url)
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(rng.random(),)) for _ in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - started
+    after = query_counts(args.url)
+
+    results = {}
+    for name, values in sorted(latencies.items()):
+        queries = sum(after[route] - before[route] for route in METRIC_ROUTES.get(name, (name,)))
+        results[name] = {
+            "requests": len(values),
+            "errors": errors[name],
+            "throughput": len(values) / wall,
+            "p50_ms": percentile(values, 50) * 1000,
+            "p95_ms": percentile(values, 95) * 1000,
+            "p99_ms": percentile(values, 99) * 1000,
+            "db_round_trips": queries / len(values),
+        }
+    report(results, json.load(open(args.baseline)) if args.baseline else None)
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+def report(results, baseline=None):
+    columns = ("requests", "errors", "throughput", "p50_ms", "p95_ms", "p99_ms", "db_round_trips")
+    print(f"{'route':<22}" + "".join(f"{c:>16}" for c in columns))
+    for name, result in results.items():
+        cells = []
+        for column in columns:
+            cell = f"{result[column]:.2f}" if isinstance(result[column], float) else str(result[column])
+            if baseline and name in baseline and baseline[name].get(column):
+                change = (result[column] - baseline[name][column]) / baseline[name][column] * 100
+                cell += f" ({change:+.0f}%)"
+            cells.append(f"{cell:>16}")
+        print(f"{name:<22}" + "".join(cells))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--dsn", default="postgres://db:db@localhost/db")
+    parser.add_argument("--seed", type=int, default=42, help="random seed, for reproducible runs")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    seed_parser = commands.add_parser("seed", help="fill the database with synthetic clinic data")
+    seed_parser.add_argument("--clients", type=int, default=10000)
+    seed_parser.add_argument("--doctors", type=int, default=50)
+    seed_parser.add_argument("--nurses", type=int, default=30)
+    seed_parser.add_argument("--appointments-per-client", type=int, default=5)
+    seed_parser.add_argument("--attendance", type=float, default=0.8, help="share of past appointments attended")
+    seed_parser.add_argument("--years", type=int, default=3)
+    seed_parser.add_argument("--diagnostic-codes", type=int, default=200)
+    seed_parser.add_argument("--medications", type=int, default=300)
+    seed_parser.add_argument("--truncate", action="store_true", help="empty the clinic tables first")
+    seed_parser.set_defaults(func=seed)
+
+    run_parser = commands.add_parser("run", help="replay a request mix against a running server")
+    run_parser.add_argument("--url", default="http://localhost:5000")
+    run_parser.add_argument("--duration", type=float, default=30, help="seconds")
+    run_parser.add_argument("--concurrency", type=int, default=8)
+    run_parser.add_argument("--mix", help='JSON weights, e.g. \'{"search_clients": 1}\'')
+    run_parser.add_argument("--baseline", help="compare with a saved result file")
+    run_parser.add_argument("--save-baseline", help="write the results to this file")
+    run_parser.set_defaults(func=run)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
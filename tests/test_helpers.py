@@ -0,0 +1,131 @@
+import io
+from datetime import datetime
+
+import pytest
+
+from app import expand_bookings, read_client_rows, validate_client_row
+
+
+def booking(**entry):
+    return {"doctor_vat": "111", "date": "2024-05-06", "time": "10:00", **entry}
+
+
+def statuses(results):
+    return [result["status"] for result in results]
+
+
+# expand_bookings
+
+@pytest.mark.parametrize("repeat", [0, -1, 53, "x", None])
+def test_repeat_out_of_bounds_is_invalid(repeat):
+    assert expand_bookings([booking(repeat=repeat)]) == [{"entry": 0, "status": "invalid"}]
+
+
+def test_repeat_bounds_are_inclusive():
+    assert len(expand_bookings([booking(repeat=1)])) == 1
+    assert len(expand_bookings([booking(repeat=52)])) == 52
+
+
+def test_repeat_books_weekly_by_default():
+    results = expand_bookings([booking(repeat=3)])
+    assert [result["date_timestamp"] for result in results] == [
+        datetime(2024, 5, 6, 10), datetime(2024, 5, 13, 10), datetime(2024, 5, 20, 10)
+    ]
+    assert [result["occurrence"] for result in results] == [0, 1, 2]
+    assert statuses(results) == [None, None, None]
+
+
+@pytest.mark.parametrize("every_days", [0, -7, "weekly"])
+def test_bad_interval_is_invalid(every_days):
+    assert statuses(expand_bookings([booking(repeat=2, every_days=every_days)])) == ["invalid"]
+
+
+@pytest.mark.parametrize(
+    "entry",
+    [
+        booking(date="2024-02-30"),
+        booking(date="06/05/2024"),
+        booking(time="25:00"),
+        booking(time=None),
+        {"doctor_vat": "111", "time": "10:00"},
+        booking(doctor_vat=""),
+        "2024-05-06 10:00",
+    ],
+)
+def test_bad_entries_are_invalid(entry):
+    assert expand_bookings([entry]) == [{"entry": 0, "status": "invalid"}]
+
+
+def test_invalid_entry_does_not_stop_the_batch():
+    results = expand_bookings([booking(date="2024-02-30"), booking()])
+    assert statuses(results) == ["invalid", None]
+    assert results[1]["entry"] == 1
+
+
+def test_duplicate_slot_in_batch_conflicts():
+    results = expand_bookings([booking(), booking(description="again")])
+    assert statuses(results) == [None, "conflict"]
+
+
+def test_series_overlapping_another_entry_conflicts_once():
+    results = expand_bookings([booking(repeat=3), booking(date="2024-05-13")])
+    assert statuses(results) == [None, None, None, "conflict"]
+
+
+def test_same_time_with_other_doctor_does_not_conflict():
+    results = expand_bookings([booking(), booking(doctor_vat="222")])
+    assert statuses(results) == [None, None]
+
+
+# read_client_rows / validate_client_row
+
+def rows(text, fmt):
+    return list(read_client_rows(io.StringIO(text), fmt))
+
+
+def test_jsonl_decode_errors_keep_their_line():
+    parsed = rows('{"VAT": "1", "name": "A", "birth_date": "2000-01-01"}\n\n{not json\n', "jsonl")
+    assert [line for line, _ in parsed] == [1, 3]
+    with pytest.raises(ValueError, match="invalid JSON"):
+        validate_client_row(parsed[1][1])
+
+
+def test_csv_lines_count_the_header():
+    parsed = rows("VAT,name,birth_date\n1,A,2000-01-01\n2,B,2000-01-02\n", "csv")
+    assert [line for line, _ in parsed] == [2, 3]
+
+
+def test_csv_row_with_too_many_fields_is_rejected():
+    (line, row), = rows("VAT,name,birth_date\n1,A,2000-01-01,extra\n", "csv")
+    assert line == 2
+    with pytest.raises(ValueError, match="more fields than the header"):
+        validate_client_row(row)
+
+
+def test_csv_row_with_too_few_fields_is_rejected():
+    (_, row), = rows("VAT,name,birth_date\n1,A\n", "csv")
+    with pytest.raises(ValueError, match="birth_date"):
+        validate_client_row(row)
+
+
+def test_valid_row_in_column_order():
+    row = {"vat": " 1 ", "Name": "A", "birth_date": "2000-01-01", "city": "", "zip": 1000}
+    assert validate_client_row(row) == ("1", "A", "2000-01-01", None, None, 1000, None)
+
+
+@pytest.mark.parametrize(
+    "row, error",
+    [
+        (["1", "A", "2000-01-01"], "JSON object"),
+        ({"name": "A", "birth_date": "2000-01-01"}, "VAT"),
+        ({"VAT": "1", "birth_date": "2000-01-01"}, "name"),
+        ({"VAT": "1", "name": "A", "birth_date": "2000-13-01"}, "birth_date"),
+        ({"VAT": "1", "name": "A"}, "birth_date"),
+        ({"VAT": "1", "name": {"x": 1}, "birth_date": "2000-01-01"}, "name must be a string"),
+        ({"VAT": "1", "name": "A", "birth_date": "2000-01-01", "zip": [1, 2]}, "zip must be a string"),
+        ({"VAT": "1", "name": "A", "birth_date": "2000-01-01", "gender": True}, "gender must be a string"),
+    ],
+)
+def test_invalid_rows_are_rejected(row, error):
+    with pytest.raises(ValueError, match=error):
+        validate_client_row(row)